@@ -1,17 +1,44 @@
+import os
+import sys
+
+# The asyncio engine is an alternative to gevent, so is chosen before
+# anything is monkey patched
+if __name__ == "__main__" and os.environ.get("ENGINE", "gevent") == "asyncio":
+    from app_asyncio import main
+
+    main()
+    sys.exit()
+
 import gevent
 from gevent import monkey
 
 monkey.patch_all()
 
+import bisect
+import errno
+import hashlib
+import html
 import json
 import logging
-import os
+import math
+import mimetypes
+import mmap
+import random
+import re
 import secrets
+import shutil
 import signal
-import sys
+import socket
+import tempfile
+import time
 import urllib.parse
+import zipfile
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from weakref import WeakSet
 
 import redis
 import requests
@@ -19,9 +46,22 @@ import sentry_sdk
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
 from flask import Flask, Response, request
+from gevent.event import AsyncResult, Event
+from gevent.pool import Pool
+from gevent.queue import Queue
 from gevent.pywsgi import WSGIHandler, WSGIServer
+from requests.adapters import HTTPAdapter
 from sentry_sdk.integrations.flask import FlaskIntegration
 from sentry_sdk.integrations.redis import RedisIntegration
+from werkzeug.http import (
+    parse_date,
+    parse_etags,
+    parse_content_range_header,
+    parse_if_range_header,
+    parse_range_header,
+    quote_etag,
+    unquote_etag,
+)
 
 # suppress very verbose boto3 logging
 logging.getLogger("boto3").setLevel(logging.CRITICAL)
@@ -31,6 +71,12 @@ logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def get_ecs_task_id():
@@ -47,7 +93,261 @@ def get_ecs_task_id():
 
 def camel_to_pascal_case(input):
     """Needed for the boto dict keys and param names, vs header names"""
-    return input.replace("_", " ").title().replace(" ", "")
+    return input.replace("_", " ").replace("-", " ").title().replace(" ", "")
+
+
+def is_content_type_in(content_type, content_types):
+    """Whether the media type of content_type is one of content_types, each
+    of which is either a media type or a type followed by /*"""
+    mimetype = content_type.partition(";")[0].strip().lower()
+    return (
+        mimetype in content_types or mimetype.partition("/")[0] + "/*" in content_types
+    )
+
+
+def parse_byte_ranges(range_header):
+    """The (start, stop) of each range of a range header, or None if invalid
+
+    Stop is exclusive, or None if the range is to the end. A start of None is
+    a suffix range, with stop its length. Unlike Werkzeug's parse_range_header,
+    ranges can overlap and be in any order, since clients send such ranges
+    """
+    if not range_header:
+        return None
+    units, _, ranges_str = range_header.partition("=")
+    if units.strip().lower() != "bytes":
+        return None
+
+    def parse_position(position_str):
+        # Not with isdigit, which is true for digits such as "²" that int
+        # doesn't accept
+        return int(position_str) if re.fullmatch("[0-9]+", position_str) else None
+
+    ranges = []
+    for range_str in ranges_str.split(","):
+        start_str, dash, stop_str = range_str.strip().partition("-")
+        if not dash:
+            return None
+        start, stop = parse_position(start_str), parse_position(stop_str)
+        if not start_str and stop is not None:
+            ranges.append((None, stop))
+        elif start is not None and not stop_str:
+            ranges.append((start, None))
+        elif start is not None and stop is not None and start <= stop:
+            ranges.append((start, stop + 1))
+        else:
+            return None
+    return ranges
+
+
+def create_lru_cache(max_entries=None, max_size=None, get_size=None, on_evict=None):
+    """A dict-like cache that evicts the least recently used entries once full
+
+    Full is either more than max_entries entries, or the sum of get_size of
+    each value being more than max_size. Returns get, set and delete
+    functions. get raises KeyError if the key is not present, and marks the
+    entry as most recently used if it is. on_evict is called with each value
+    that is removed, whether evicted, replaced or deleted
+    """
+    entries = OrderedDict()
+    total_size = 0
+
+    def is_full():
+        return (max_entries is not None and len(entries) > max_entries) or (
+            max_size is not None and total_size > max_size
+        )
+
+    def remove(key):
+        nonlocal total_size
+        value = entries.pop(key)
+        if get_size is not None:
+            total_size -= get_size(value)
+        if on_evict is not None:
+            on_evict(value)
+
+    def get(key):
+        value = entries[key]
+        entries.move_to_end(key)
+        return value
+
+    def set(key, value):
+        nonlocal total_size
+        if key in entries:
+            remove(key)
+        entries[key] = value
+        if get_size is not None:
+            total_size += get_size(value)
+        while entries and is_full():
+            remove(next(iter(entries)))
+
+    def delete(key):
+        if key in entries:
+            remove(key)
+
+    return get, set, delete
+
+
+def create_counter(name, documentation, label_names=()):
+    """A Prometheus counter, as a function that increments it for the given
+    values of its labels, and a function that returns it for format_metrics"""
+    values = defaultdict(float)
+
+    def inc(*label_values, amount=1):
+        values[label_values] += amount
+
+    def collect():
+        return (
+            name,
+            documentation,
+            "counter",
+            [
+                (name, dict(zip(label_names, label_values)), value)
+                for label_values, value in values.items()
+            ],
+        )
+
+    return inc, collect
+
+
+def create_histogram(name, documentation, buckets, label_names=()):
+    """A Prometheus histogram, as a function that observes a value for the
+    given values of its labels, and a function that returns it for
+    format_metrics. Each bucket is an inclusive upper bound, in order"""
+    counts = {}
+    sums = defaultdict(float)
+
+    def observe(value, *label_values):
+        try:
+            bucket_counts = counts[label_values]
+        except KeyError:
+            bucket_counts = counts[label_values] = [0] * (len(buckets) + 1)
+        bucket_counts[bisect.bisect_left(buckets, value)] += 1
+        sums[label_values] += value
+
+    def collect():
+        samples = []
+        for label_values, bucket_counts in counts.items():
+            labels = dict(zip(label_names, label_values))
+            cumulative_count = 0
+            for bucket, count in zip(buckets + (math.inf,), bucket_counts):
+                cumulative_count += count
+                samples.append(
+                    (f"{name}_bucket", {**labels, "le": bucket}, cumulative_count)
+                )
+            samples.append((f"{name}_sum", labels, sums[label_values]))
+            samples.append((f"{name}_count", labels, cumulative_count))
+        return name, documentation, "histogram", samples
+
+    return observe, collect
+
+
+def create_gauge(name, documentation, get_values, label_names=()):
+    """A Prometheus gauge whose (label values, value) pairs are returned by
+    get_values when collected, as a function that returns it for
+    format_metrics"""
+
+    def collect():
+        return (
+            name,
+            documentation,
+            "gauge",
+            [
+                (name, dict(zip(label_names, label_values)), value)
+                for label_values, value in get_values()
+            ],
+        )
+
+    return collect
+
+
+def format_metrics(metrics, constant_labels):
+    """The Prometheus text format of the metrics, each as returned by the
+    collect function of a counter, histogram or gauge"""
+
+    def format_value(value):
+        return "+Inf" if value == math.inf else repr(float(value))
+
+    def format_label_value(key, value):
+        value = format_value(value) if key == "le" else str(value)
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return (
+            "{"
+            + ",".join(
+                f'{key}="{format_label_value(key, value)}"'
+                for key, value in labels.items()
+            )
+            + "}"
+        )
+
+    lines = []
+    for name, documentation, metric_type, samples in metrics:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample_name, labels, value in samples:
+            lines.append(
+                f"{sample_name}{format_labels({**constant_labels, **labels})} "
+                f"{format_value(value)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def sample_stacks(thread_id, seconds, interval, sleep):
+    """The stacks of the thread, sampled every interval seconds for the number
+    of seconds, in the collapsed format of flamegraph.pl. Must be called from
+    another thread, with a sleep that blocks just that thread
+
+    With gevent, the stack sampled is of whichever greenlet is running, or
+    the hub's if none are, so the time spent idle is included
+    """
+    counts = defaultdict(int)
+    stop_at = time.monotonic() + seconds
+    while time.monotonic() < stop_at:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        counts[";".join(reversed(stack))] += 1
+        sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+@contextmanager
+def timed(observe, *label_values):
+    """Observes the number of seconds the block takes, even if it raises"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(time.monotonic() - start, *label_values)
+
+
+class ChunkWriter:
+    """A write-only file-like object that collects what's written to it
+
+    It can't seek or tell, so zipfile writes each member's sizes after its
+    data rather than seeking back to its header, and so the archive can be
+    streamed as it's written
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop_chunks(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
 
 
 def get_boto_s3client_args(
@@ -56,12 +356,29 @@ def get_boto_s3client_args(
     aws_region=None,
     use_local=None,
     endpoint=None,
+    max_pool_connections=None,
+    connect_timeout=None,
+    read_timeout=None,
+    tcp_keepalive=None,
 ):
     """Extracted to a function to allow monkey-patching for test run"""
     args = ("s3",)
+    config_kwargs = {}
+
+    if max_pool_connections is not None:
+        config_kwargs["max_pool_connections"] = max_pool_connections
+    if connect_timeout is not None:
+        config_kwargs["connect_timeout"] = connect_timeout
+    if read_timeout is not None:
+        config_kwargs["read_timeout"] = read_timeout
+    if tcp_keepalive is not None:
+        config_kwargs["tcp_keepalive"] = tcp_keepalive
+
     kwargs = {
         "config": Config(
-            signature_version="v4", retries={"max_attempts": 10, "mode": "standard"}
+            signature_version="v4",
+            retries={"max_attempts": 10, "mode": "standard"},
+            **config_kwargs,
         ),
     }
 
@@ -100,10 +417,68 @@ def proxy_app(
     sentry_dsn=None,
     sentry_enable_tracing=False,
     sentry_trace_sample_rate=0.0,
+    stream_chunk_size=16384,
+    stream_max_chunk_size=1048576,
+    max_concurrent_connections=None,
+    s3_max_pool_connections=None,
+    s3_connect_timeout=None,
+    s3_read_timeout=None,
+    s3_tcp_keepalive=None,
+    reuse_port=False,
+    session_cache_size=0,
+    session_cache_ttl=5,
+    sso_max_pool_connections=10,
+    sso_connect_timeout=5,
+    sso_read_timeout=10,
+    sso_token_check_lock_timeout=0,
+    disk_cache_dir=None,
+    disk_cache_max_size=1073741824,
+    disk_cache_max_object_size=104857600,
+    disk_cache_max_age=0,
+    memory_cache_max_size=0,
+    memory_cache_max_object_size=262144,
+    memory_cache_max_age=0,
+    cache_control=None,
+    parallel_download_min_size=0,
+    parallel_download_part_size=8388608,
+    parallel_download_concurrency=4,
+    read_ahead_block_size=0,
+    read_ahead_cache_max_size=67108864,
+    read_ahead_cache_ttl=10,
+    stream_buffer_size=0,
+    stream_min_throughput=0,
+    stream_min_throughput_period=10,
+    compression_content_types=(),
+    compression_min_size=1024,
+    precompressed_encodings=(),
+    precompressed_cache_size=10000,
+    precompressed_cache_ttl=60,
+    redirect_min_size=0,
+    redirect_content_types=(),
+    presigned_url_expiry=300,
+    presigned_url_cache_size=10000,
+    zip_path=None,
+    zip_max_keys=1000,
+    zip_concurrency=4,
+    enable_listing=False,
+    listing_page_size=1000,
+    listing_cache_size=1000,
+    listing_cache_ttl=5,
+    metrics_path=None,
+    access_log_sample_rate=1.0,
+    profiling_path=None,
+    profiling_token=None,
+    enable_server_timing=False,
 ):
     proxied_request_headers = [
         "range",
     ]
+    conditional_request_headers = [
+        "if-match",
+        "if-none-match",
+        "if-modified-since",
+        "if-unmodified-since",
+    ]
     proxied_response_headers = [
         "accept-ranges",
         "content-length",
@@ -113,6 +488,34 @@ def proxy_app(
         "last-modified",
         "content-range",
     ]
+    cache_control_headers = (
+        [("cache-control", cache_control)] if cache_control is not None else []
+    )
+    max_ranges = 32
+    s3_default_max_pool_connections = 100
+    profiling_max_seconds = 60
+    profiling_interval = 0.01
+    server_timings = (
+        ("auth", "Authentication", "s3proxy.auth_seconds"),
+        ("s3", "S3 first byte", "s3proxy.s3_first_byte_seconds"),
+        ("app", "Until the response starts", "s3proxy.app_seconds"),
+    )
+    # Encodings in order of preference, with brotli only if it's installed
+    compression_encodings = (["br"] if brotli is not None else []) + ["gzip"]
+    vary_headers = [("vary", "accept-encoding")]
+    # Siblings of objects compressed in advance, such as by a build pipeline,
+    # and the content types they are likely to have been uploaded with
+    precompressed_suffixes = {
+        encoding: {"br": ".br", "gzip": ".gz"}[encoding]
+        for encoding in precompressed_encodings
+    }
+    precompressed_generic_content_types = (
+        "application/gzip",
+        "application/x-gzip",
+        "application/x-brotli",
+        "application/octet-stream",
+        "binary/octet-stream",
+    )
     redis_prefix = "s3proxy"
     redis_client = redis.from_url(redis_url)
 
@@ -121,20 +524,245 @@ def proxy_app(
     else:
         key_prefix = ""
 
+    # Each concurrent download holds an S3 connection for its duration, so by
+    # default the pool is sized to allow one for every client connection, or
+    # if they're not limited, well beyond botocore's default of 10
+    if s3_max_pool_connections is None:
+        s3_max_pool_connections = (
+            max_concurrent_connections
+            if max_concurrent_connections is not None
+            else s3_default_max_pool_connections
+        )
+
     boto_args, boto_kwargs = get_boto_s3client_args(
         aws_access_key_id,
         aws_secret_access_key,
         aws_region,
         s3_use_local,
         s3_endpoint_url,
+        s3_max_pool_connections,
+        s3_connect_timeout,
+        s3_read_timeout,
+        s3_tcp_keepalive,
     )
     s3 = boto3.client(*boto_args, **boto_kwargs)
 
+    # Connections to SSO are reused between token exchanges and checks,
+    # rather than a new TCP and TLS connection being made for each
+    sso_session = requests.Session()
+    sso_adapter = HTTPAdapter(pool_maxsize=sso_max_pool_connections)
+    sso_session.mount("http://", sso_adapter)
+    sso_session.mount("https://", sso_adapter)
+    sso_timeout = (sso_connect_timeout, sso_read_timeout)
+
+    # Sessions recently validated against Redis and SSO, mapped to the
+    # monotonic time until which they can be trusted without checking again
+    session_cache_get, session_cache_set, session_cache_delete = create_lru_cache(
+        session_cache_size
+    )
+
+    # Objects stored on local disk, keyed by S3 key. Each has a file in a
+    # directory for just this process, so workers don't need to coordinate.
+    # An object is served from disk if S3 confirms its ETag is unchanged, or
+    # without asking S3 at all for disk_cache_max_age seconds after that
+    def remove_disk_cache_file(cached):
+        try:
+            os.remove(cached["path"])
+        except FileNotFoundError:
+            pass
+
+    def is_process_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # Running, but as another user
+            return True
+        return True
+
+    def remove_stale_disk_cache_paths():
+        # Directories left by processes that exited without removing them,
+        # such as workers that crashed. Each is named with the ID of its
+        # process, and one with the ID of this process is from before a
+        # restart that reused it
+        for name in os.listdir(disk_cache_dir):
+            match = re.fullmatch(r"s3proxy-([0-9]+)-.*", name)
+            if match is None:
+                continue
+            pid = int(match[1])
+            if pid == os.getpid() or not is_process_running(pid):
+                shutil.rmtree(os.path.join(disk_cache_dir, name), ignore_errors=True)
+
+    if disk_cache_dir is not None:
+        remove_stale_disk_cache_paths()
+        disk_cache_path = tempfile.mkdtemp(
+            prefix=f"s3proxy-{os.getpid()}-", dir=disk_cache_dir
+        )
+        disk_cache_max_object_size = min(
+            disk_cache_max_object_size, disk_cache_max_size
+        )
+    disk_cache_get, disk_cache_set, disk_cache_delete = create_lru_cache(
+        max_size=disk_cache_max_size,
+        get_size=lambda cached: cached["size"],
+        on_evict=remove_disk_cache_file,
+    )
+
+    # Small objects held in memory, in the same way as on disk
+    memory_cache_max_object_size = min(
+        memory_cache_max_object_size, memory_cache_max_size
+    )
+    memory_cache_get, memory_cache_set, memory_cache_delete = create_lru_cache(
+        max_size=memory_cache_max_size,
+        get_size=lambda cached: cached["size"],
+    )
+
+    # Blocks of objects read ahead of range requests, keyed by S3 key and
+    # index of the block, and served without asking S3 for a short time
+    read_ahead_cache_get, read_ahead_cache_set, _ = create_lru_cache(
+        max_size=read_ahead_cache_max_size,
+        get_size=lambda block: len(block["data"]),
+    )
+
+    # Whether precompressed siblings exist, keyed by their S3 key, mapped to
+    # the monotonic time until which that can be trusted
+    precompressed_cache_get, precompressed_cache_set, _ = create_lru_cache(
+        precompressed_cache_size
+    )
+
+    # Presigned URLs of objects large enough to redirect to, keyed by S3 key,
+    # with the monotonic time until which each is reused. Objects found not
+    # to be redirected to have None in place of a URL
+    presigned_url_cache_get, presigned_url_cache_set, _ = create_lru_cache(
+        presigned_url_cache_size
+    )
+
+    # Pages of folder listings, keyed by folder, continuation token and page
+    # size, with the monotonic time until which each is served without S3
+    listing_cache_get, listing_cache_set, _ = create_lru_cache(listing_cache_size)
+
+    # Metrics of this process, served in the Prometheus text format
+    latency_buckets = (
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+    observe_s3_first_byte, collect_s3_first_byte = create_histogram(
+        "s3proxy_s3_time_to_first_byte_seconds",
+        "Seconds from requesting an object from S3 to receiving its headers",
+        latency_buckets,
+        ("method",),
+    )
+    observe_response_duration, collect_response_duration = create_histogram(
+        "s3proxy_response_duration_seconds",
+        "Seconds from receiving a request to sending the end of its response",
+        (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+        ("status",),
+    )
+    observe_response_bytes, collect_response_bytes = create_histogram(
+        "s3proxy_response_bytes",
+        "Bytes sent in the body of each response",
+        (1024, 16384, 262144, 4194304, 67108864, 1073741824, 17179869184),
+        ("status",),
+    )
+    observe_redis, collect_redis = create_histogram(
+        "s3proxy_redis_duration_seconds",
+        "Seconds each call to Redis takes",
+        latency_buckets,
+        ("command",),
+    )
+    observe_sso, collect_sso = create_histogram(
+        "s3proxy_sso_duration_seconds",
+        "Seconds each request to SSO takes",
+        latency_buckets,
+        ("endpoint",),
+    )
+    inc_auth_outcomes, collect_auth_outcomes = create_counter(
+        "s3proxy_auth_outcomes_total",
+        "Requests by how they were authenticated",
+        ("outcome",),
+    )
+
+    requests_in_progress = 0
+    collect_requests_in_progress = create_gauge(
+        "s3proxy_requests_in_progress",
+        "Requests being handled, each by its own greenlet",
+        lambda: [((), requests_in_progress)],
+    )
+
+    # Bodies of objects requested from S3 that hold a connection, until
+    # they've been read to the end or closed. Weak, so bodies dropped without
+    # either, whose connections are closed once garbage collected, don't
+    # count forever
+    s3_bodies_in_use = WeakSet()
+
+    def get_object(**kwargs):
+        s3_obj = s3.get_object(**kwargs)
+        s3_bodies_in_use.add(s3_obj["Body"])
+        return s3_obj
+
+    def close_body(body):
+        s3_bodies_in_use.discard(body)
+        body.close()
+
+    @contextmanager
+    def closing_body(body):
+        try:
+            yield body
+        finally:
+            close_body(body)
+
+    def get_s3_pool_connections():
+        return [
+            (("in_use",), len(s3_bodies_in_use)),
+            (("max",), s3_max_pool_connections),
+        ]
+
+    collect_s3_pool_connections = create_gauge(
+        "s3proxy_s3_pool_connections",
+        "Connections to S3 in use, and the most that are kept open",
+        get_s3_pool_connections,
+        ("state",),
+    )
+
+    metrics_collectors = (
+        collect_s3_first_byte,
+        collect_response_duration,
+        collect_response_bytes,
+        collect_redis,
+        collect_sso,
+        collect_auth_outcomes,
+        collect_requests_in_progress,
+        collect_s3_pool_connections,
+    )
+    # With multiple workers each has its own metrics, and a scrape is answered
+    # by whichever accepts the connection, so they're told apart by process
+    metrics_labels = {"pid": os.getpid()} if reuse_port else {}
+
     def start():
+        # Returns once stopped and in-progress requests have completed. With
+        # a pool, serve_forever waits for them, but without one it returns
+        # as soon as the server is closed, so they're waited for by joining
+        # the hub. Only then can nothing be using the disk cache
         server.serve_forever()
+        gevent.get_hub().join()
+        if disk_cache_dir is not None:
+            shutil.rmtree(disk_cache_path, ignore_errors=True)
 
     def stop(_, __):
-        server.stop()
+        # Called from the event loop, where blocking to wait for in-progress
+        # requests isn't allowed. Closing stops accepting connections and
+        # wakes serve_forever
+        server.close()
 
     def authenticate_by_sso(f):
         auth_path = "o/authorize/"
@@ -150,6 +778,8 @@ def proxy_app(
         session_state_key_prefix = "sso_state"
         session_token_key = "sso_token"
         session_token_checked_key = "sso_token_checked"
+        token_check_lock_prefix = "sso_token_check_lock"
+        token_check_result_prefix = "sso_token_check_result"
 
         expired_message = (
             b'<p style="font-weight: bold; font-family: Helvetica, Arial,'
@@ -161,6 +791,16 @@ def proxy_app(
         redis_max_age_session = 60 * 60 * 10
         redis_max_age_state = 60
 
+        # Checks of tokens against SSO currently in progress in this process,
+        # keyed by the hash of the token, so concurrent requests for the same
+        # session, such as for all the assets on a page, share a single check
+        token_checks_in_progress = {}
+
+        # Counted in the metrics, and included in the access log
+        def record_auth_outcome(outcome):
+            inc_auth_outcomes(outcome)
+            request.environ["s3proxy.auth_outcome"] = outcome
+
         @wraps(f)
         def _authenticate_by_sso(*args, **kwargs):
             if request.path == f"/{healthcheck_key}":
@@ -168,10 +808,46 @@ def proxy_app(
                 return f(*args, **kwargs)
 
             logger.debug("Authenticating %s", request)
+            auth_started = time.monotonic()
+            if session_cookie_name in request.cookies:
+                request.environ["s3proxy.session_id"] = request.cookies[
+                    session_cookie_name
+                ]
+
+            def authenticated():
+                request.environ["s3proxy.auth_seconds"] = (
+                    time.monotonic() - auth_started
+                )
+                return f(*args, **kwargs)
 
-            def get_session_value(key):
+            def get_session_values(*keys):
                 session_id = request.cookies[session_cookie_name]
-                return redis_get(f"{session_cookie_name}__{session_id}__{key}")
+                return redis_get_many_with_ttl(
+                    f"{session_cookie_name}__{session_id}__{key}" for key in keys
+                )
+
+            # The in-process cache only ever shortcuts the checks against
+            # Redis and SSO for at most session_cache_ttl, and never beyond
+            # when those checks would next be needed
+            def is_session_recently_validated():
+                if not session_cache_size:
+                    return False
+                try:
+                    session_id = request.cookies[session_cookie_name]
+                    valid_until = session_cache_get(session_id)
+                except KeyError:
+                    return False
+                if valid_until > time.monotonic():
+                    return True
+                session_cache_delete(session_id)
+                return False
+
+            def set_session_recently_validated(ttl):
+                if not session_cache_size:
+                    return
+                session_id = request.cookies[session_cookie_name]
+                valid_until = time.monotonic() + min(ttl, session_cache_ttl)
+                session_cache_set(session_id, valid_until)
 
             # In our case all session values are set exactly when we want a
             # new session cookie
@@ -187,14 +863,22 @@ def proxy_app(
                     max_age=cookie_max_age,
                     expires=datetime.utcnow().timestamp() + cookie_max_age,
                 )
-                for key, value in session_values.items():
-                    redis_set(
-                        f"{session_cookie_name}__{session_id}__{key}",
-                        value,
-                        redis_max_age_session,
-                    )
-
-                set_token_recently_checked_redis_key(session_id)
+                # All values, and the token-checked flag, are set in a single
+                # pipelined round trip
+                session_key_prefix = f"{session_cookie_name}__{session_id}"
+                redis_set_many(
+                    [
+                        (f"{session_key_prefix}__{key}", value, redis_max_age_session)
+                        for key, value in session_values.items()
+                    ]
+                    + [
+                        (
+                            f"{session_key_prefix}__{session_token_checked_key}",
+                            "checked",
+                            sso_token_check_grace_period,
+                        )
+                    ]
+                )
 
                 return response
 
@@ -211,6 +895,7 @@ def proxy_app(
 
             def redirect_to_sso():
                 logger.debug("Redirecting to SSO: {")
+                record_auth_outcome("redirect")
                 callback_uri = urllib.parse.quote(get_callback_uri(), safe="")
                 state = secrets.token_hex(32)
                 redis_set(
@@ -254,8 +939,8 @@ def proxy_app(
                     "client_secret": sso_client_secret,
                     "redirect_uri": get_callback_uri(),
                 }
-                with requests.post(
-                    f"{sso_url_internal}{token_path}", data=data
+                with timed(observe_sso, "token"), sso_session.post(
+                    f"{sso_url_internal}{token_path}", data=data, timeout=sso_timeout
                 ) as response:
                     content = response.content
 
@@ -276,47 +961,106 @@ def proxy_app(
                 return response
 
             def get_token_code(token):
-                with requests.get(
+                with timed(observe_sso, "me"), sso_session.get(
                     f"{sso_url_internal}{me_path}",
                     headers={"authorization": f"Bearer {token}"},
+                    timeout=sso_timeout,
                 ) as response:
                     return response.status_code
 
-            def is_token_check_required():
+            def get_token_code_coalesced(token):
+                token_hash = hashlib.sha256(token.encode()).hexdigest()
                 try:
-                    get_session_value(session_token_checked_key)
+                    return token_checks_in_progress[token_hash].get()
                 except KeyError:
-                    return True
+                    pass
 
-                return False
+                result = AsyncResult()
+                token_checks_in_progress[token_hash] = result
+                try:
+                    token_code = get_token_code_across_processes(token, token_hash)
+                except Exception as e:
+                    result.set_exception(e)
+                    raise
+                else:
+                    result.set(token_code)
+                    return token_code
+                finally:
+                    del token_checks_in_progress[token_hash]
+
+            def get_token_code_across_processes(token, token_hash):
+                # Optionally one process checks the token while any others
+                # wait for it to store the result in Redis. If it doesn't in
+                # time, say if the process died, the others check themselves
+                if not sso_token_check_lock_timeout:
+                    return get_token_code(token)
+
+                lock_key = f"{token_check_lock_prefix}__{token_hash}"
+                result_key = f"{token_check_result_prefix}__{token_hash}"
+                lock_timeout_ms = int(sso_token_check_lock_timeout * 1000)
+
+                if redis_set_if_not_exists(lock_key, "locked", lock_timeout_ms):
+                    token_code = get_token_code(token)
+                    redis_set_if_not_exists(
+                        result_key, str(token_code), lock_timeout_ms
+                    )
+                    return token_code
+
+                give_up_at = time.monotonic() + sso_token_check_lock_timeout
+                while time.monotonic() < give_up_at:
+                    try:
+                        return int(redis_get(result_key))
+                    except KeyError:
+                        gevent.sleep(0.05)
+
+                return get_token_code(token)
 
             def set_token_recently_checked_redis_key(session_id):
                 return redis_set(f"{session_cookie_name}__{session_id}__{session_token_checked_key}", "checked", sso_token_check_grace_period)
 
             if request.path == redirect_from_sso_path:
+                record_auth_outcome("sign_in")
                 return redirect_to_final()
 
+            if is_session_recently_validated():
+                record_auth_outcome("cached")
+                return authenticated()
+
+            # Both values, and how long they have left, are fetched in a
+            # single round trip to Redis
             try:
-                token = get_session_value(session_token_key)
+                (token, token_ttl), (token_checked, token_checked_ttl) = (
+                    get_session_values(session_token_key, session_token_checked_key)
+                )
             except KeyError:
                 return redirect_to_sso()
 
-            if is_token_check_required():
-                logging.debug("Verifying access token")
+            if token is None:
+                return redirect_to_sso()
+
+            if token_checked is None:
+                logger.debug("Verifying access token")
 
-                token_code = get_token_code(token)
+                token_code = get_token_code_coalesced(token)
 
                 if token_code in [401, 403]:
                     logger.debug("token_code response is %s", token_code)
                     return redirect_to_sso()
 
                 if token_code != 200:
+                    record_auth_outcome("error")
                     return Response(b"", 500)
 
+                record_auth_outcome("verified")
                 session_id = request.cookies[session_cookie_name]
                 set_token_recently_checked_redis_key(session_id)
+                token_checked_ttl = sso_token_check_grace_period
+            else:
+                record_auth_outcome("recently_checked")
+
+            set_session_recently_validated(min(token_ttl, token_checked_ttl))
 
-            return f(*args, **kwargs)
+            return authenticated()
 
         return _authenticate_by_sso
 
@@ -324,9 +1068,189 @@ def proxy_app(
     def proxy(path):
         logger.debug("Attempt to proxy: %s", request)
 
-        def body_upstream(streamingBody):
-            for chunk in streamingBody.iter_chunks(chunk_size=16384):
+        def body_upstream(streamingBody, content_length, max_chunk_size=None):
+            # Read with botocore's read, which raises if the body ends before
+            # its content-length, and urllib3 returns the connection to the
+            # pool once it has seen the end, so the body no longer holds it.
+            # The chunk size doubles each time a read fills it, so large
+            # objects are streamed with far fewer iterations, but only while
+            # the rest of the object needs it, so small objects are only ever
+            # read in small chunks
+            if max_chunk_size is None:
+                max_chunk_size = stream_max_chunk_size
+            chunk_size = min(stream_chunk_size, max_chunk_size)
+            amount_read = 0
+
+            while True:
+                chunk = streamingBody.read(chunk_size)
+                if not chunk:
+                    s3_bodies_in_use.discard(streamingBody)
+                    break
+                amount_read += len(chunk)
                 yield chunk
+                if (
+                    len(chunk) == chunk_size
+                    and chunk_size < max_chunk_size
+                    and content_length - amount_read > chunk_size
+                ):
+                    chunk_size = min(chunk_size * 2, max_chunk_size)
+
+        def body_buffered(streamingBody, content_length):
+            # S3 is read by another greenlet into a buffer of up to
+            # stream_buffer_size bytes, so the S3 connection is only waiting
+            # on the client when the buffer is full. Objects that fit in the
+            # buffer are read in full and the connection returned to the pool
+            # however slowly the client receives them. S3 is read in the same
+            # way as by body_upstream, but in chunks no larger than the buffer
+            chunks = Queue()
+            amount_buffered = 0
+            has_space = Event()
+            has_space.set()
+
+            def read():
+                nonlocal amount_buffered
+                try:
+                    for chunk in body_upstream(
+                        streamingBody,
+                        content_length,
+                        min(stream_max_chunk_size, stream_buffer_size),
+                    ):
+                        amount_buffered += len(chunk)
+                        if amount_buffered >= stream_buffer_size:
+                            has_space.clear()
+                        chunks.put(chunk)
+                        has_space.wait()
+                    chunks.put(None)
+                except Exception as exception:
+                    chunks.put(exception)
+
+            reader = gevent.spawn(read)
+            try:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    amount_buffered -= len(chunk)
+                    if amount_buffered < stream_buffer_size:
+                        has_space.set()
+                    yield chunk
+            finally:
+                reader.kill()
+
+        def body_with_min_throughput(chunks, client_socket):
+            # The client is disconnected if, after the first period, it has
+            # received less than stream_min_throughput bytes per second on
+            # average, so stalled clients don't hold S3 connections. Since the
+            # greenlet writing to a stalled client is blocked, the check runs
+            # in another. Chunks are split so a client receiving at exactly
+            # the minimum rate completes at least one each period
+            max_chunk_size = max(
+                int(stream_min_throughput * stream_min_throughput_period), 1
+            )
+            started = time.monotonic()
+            amount_sent = 0
+
+            def check():
+                while True:
+                    gevent.sleep(stream_min_throughput_period)
+                    elapsed = time.monotonic() - started
+                    if amount_sent < stream_min_throughput * (
+                        elapsed - stream_min_throughput_period
+                    ):
+                        break
+                logger.warning(
+                    "Disconnecting client after %s bytes in %.1f seconds",
+                    amount_sent,
+                    elapsed,
+                )
+                client_socket.shutdown(socket.SHUT_RDWR)
+
+            checker = gevent.spawn(check)
+            try:
+                for chunk in chunks:
+                    view = memoryview(chunk)
+                    for offset in range(0, len(view), max_chunk_size):
+                        end = min(offset + max_chunk_size, len(view))
+                        part = view[offset:end]
+                        yield part
+                        amount_sent += len(part)
+            finally:
+                checker.kill()
+
+        def body_parts(first_part_body, s3_key, etag, start, first_part_size, stop):
+            # The first part is streamed from the response to the request for
+            # just it, so the response is read in full. The rest, if at least
+            # parallel_download_min_size, is split into parts fetched by
+            # concurrent range requests, each pinned to the ETag of the first,
+            # and otherwise is streamed from a single range request
+            rest_start = start + first_part_size
+            if stop - start >= parallel_download_min_size:
+                yield from body_parallel(
+                    first_part_body, s3_key, etag, start, first_part_size, stop
+                )
+                return
+
+            rest_request = gevent.spawn(
+                get_object,
+                Bucket=bucket,
+                Key=s3_key,
+                Range=f"bytes={rest_start}-{stop - 1}",
+                IfMatch=etag,
+            )
+            try:
+                yield from body_upstream(first_part_body, first_part_size)
+                with closing_body(rest_request.get()["Body"]) as body:
+                    if stream_buffer_size:
+                        yield from body_buffered(body, stop - rest_start)
+                    else:
+                        yield from body_upstream(body, stop - rest_start)
+            finally:
+                rest_request.kill()
+                if rest_request.successful():
+                    close_body(rest_request.value["Body"])
+
+        def body_parallel(first_part_body, s3_key, etag, start, first_part_size, stop):
+            # At most parallel_download_concurrency parts after the first are
+            # in progress or waiting to be sent at once, so memory use is
+            # bounded however large the object
+            def get_part(part_start, part_stop):
+                part = get_object(
+                    Bucket=bucket,
+                    Key=s3_key,
+                    Range=f"bytes={part_start}-{part_stop - 1}",
+                    IfMatch=etag,
+                )
+                with closing_body(part["Body"]):
+                    return part["Body"].read()
+
+            part_starts = iter(
+                range(start + first_part_size, stop, parallel_download_part_size)
+            )
+            parts = deque()
+
+            def get_next_part():
+                try:
+                    part_start = next(part_starts)
+                except StopIteration:
+                    return
+                part_stop = min(part_start + parallel_download_part_size, stop)
+                parts.append(gevent.spawn(get_part, part_start, part_stop))
+
+            try:
+                for _ in range(parallel_download_concurrency):
+                    get_next_part()
+
+                # Streamed so the client isn't waiting for it all
+                yield from body_upstream(first_part_body, first_part_size)
+
+                while parts:
+                    part = parts.popleft()
+                    get_next_part()
+                    yield part.get()
+            finally:
+                gevent.killall(parts)
 
         def body_empty(streamingBody):
             # Ensure this is a generator
@@ -335,59 +1259,1415 @@ def proxy_app(
             for _ in iter(streamingBody):
                 pass
 
-        request_kwargs = {"Bucket": bucket, "Key": key_prefix + path}
+        def body_to_disk_cache(chunks, s3_key, etag, headers, content_length):
+            # Each chunk is written to disk before being passed on, since the
+            # buffer it's in is reused for the next. The file name is unique
+            # to this write, so concurrent requests for the same object or a
+            # reader of a previous version of it are unaffected
+            path = os.path.join(disk_cache_path, secrets.token_hex(16))
+            file = open(path, "wb")
+            try:
+                for chunk in chunks:
+                    if file is not None:
+                        try:
+                            file.write(chunk)
+                        except OSError:
+                            logger.exception("Unable to write to disk cache")
+                            file.close()
+                            file = None
+                    yield chunk
+            except BaseException:
+                if file is not None:
+                    file.close()
+                    os.remove(path)
+                raise
+
+            if file is None:
+                os.remove(path)
+                return
+
+            file.close()
+            disk_cache_set(
+                s3_key,
+                {
+                    "path": path,
+                    "etag": etag,
+                    "size": content_length,
+                    "headers": headers,
+                    "fresh_until": time.monotonic() + disk_cache_max_age,
+                },
+            )
+
+        def body_from_disk_cache(file, start, stop):
+            # The file was opened before any chance of eviction, and an
+            # unlinked file's contents remain available while it's open
+            with file:
+                if start == stop:
+                    return
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(start, stop, stream_max_chunk_size):
+                        end = min(offset + stream_max_chunk_size, stop)
+                        yield mapped[offset:end]
+
+        def body_to_memory_cache(chunks, cache_key, etag, headers, content_length):
+            # Copied as it's streamed, since the buffer each chunk is in is
+            # reused for the next. The length of a compressed body isn't known
+            # in advance, so it's only cached if it turns out small enough
+            content = bytearray(content_length or 0)
+            offset = 0
+            for chunk in chunks:
+                end = offset + len(chunk)
+                if content is not None:
+                    content[offset:end] = chunk
+                    if end > memory_cache_max_object_size:
+                        content = None
+                offset = end
+                yield chunk
+
+            if content is None:
+                return
+
+            memory_cache_set(
+                cache_key,
+                {
+                    "content": content,
+                    "etag": etag,
+                    "size": offset,
+                    "headers": headers,
+                    "fresh_until": time.monotonic() + memory_cache_max_age,
+                },
+            )
+
+        def body_from_memory_cache(content, start, stop):
+            yield memoryview(content)[start:stop]
+
+        def is_compressible(headers, content_length):
+            return content_length >= compression_min_size and is_content_type_in(
+                headers.get("content-type", ""), compression_content_types
+            )
+
+        def is_redirectable(headers, size):
+            return size >= redirect_min_size and (
+                not redirect_content_types
+                or is_content_type_in(
+                    headers.get("content-type", ""), redirect_content_types
+                )
+            )
+
+        def response_redirect(s3_key):
+            # Each URL is reused for most of its lifetime, but not so much
+            # that a client is given one too close to expiring to use
+            try:
+                presigned_url, reuse_until = presigned_url_cache_get(s3_key)
+            except KeyError:
+                presigned_url, reuse_until = None, 0
+            if presigned_url is None or time.monotonic() >= reuse_until:
+                presigned_url = s3.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": bucket, "Key": s3_key},
+                    ExpiresIn=presigned_url_expiry,
+                )
+                presigned_url_cache_set(
+                    s3_key,
+                    (presigned_url, time.monotonic() + presigned_url_expiry * 0.8),
+                )
+            logger.debug("Redirecting to presigned URL")
+            response = Response(status=302, headers={"location": presigned_url})
+            response.autocorrect_location_header = False
+            return response
+
+        def compressed_headers(headers, content_encoding):
+            # The compressed representation isn't byte-for-byte the object, so
+            # only has a weak version of its ETag, and its length isn't known
+            # until it's been sent
+            return tuple(
+                (key, "W/" + value if key == "etag" else value)
+                for key, value in headers
+                if key != "content-length"
+            ) + (("content-encoding", content_encoding),)
+
+        def body_compressed(chunks, content_encoding):
+            if content_encoding == "br":
+                compressor = brotli.Compressor(quality=4)
+                compress, flush = compressor.process, compressor.finish
+            else:
+                # A wbits of 31 is the gzip format, rather than raw zlib
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                compress, flush = compressor.compress, compressor.flush
+            for chunk in chunks:
+                compressed = compress(chunk)
+                if compressed:
+                    yield compressed
+            yield flush()
+
+        def sibling_exists(sibling_key):
+            try:
+                s3.head_object(Bucket=bucket, Key=sibling_key)
+            except ClientError as e:
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] in (403, 404):
+                    return False
+                raise
+            return True
+
+        def get_precompressed_encoding(s3_key):
+            # The encoding the client prefers of those the object has a
+            # sibling for, if any. Whether each exists is cached, so most
+            # requests need no extra request to S3 to find out
+            accepted_encodings = sorted(
+                (
+                    encoding
+                    for encoding in precompressed_encodings
+                    if request.accept_encodings[encoding]
+                ),
+                key=lambda encoding: request.accept_encodings[encoding],
+                reverse=True,
+            )
+            for encoding in accepted_encodings:
+                sibling_key = s3_key + precompressed_suffixes[encoding]
+                try:
+                    exists, fresh_until = precompressed_cache_get(sibling_key)
+                except KeyError:
+                    fresh_until = 0
+                if time.monotonic() >= fresh_until:
+                    exists = sibling_exists(sibling_key)
+                    precompressed_cache_set(
+                        sibling_key,
+                        (exists, time.monotonic() + precompressed_cache_ttl),
+                    )
+                if exists:
+                    return encoding
+            return None
+
+        def precompressed_headers(headers, s3_key, content_encoding):
+            # Siblings are often uploaded with a content type of the
+            # compression format rather than of the object, so it's guessed
+            # from the object's key instead
+            content_type = dict(headers).get("content-type", "")
+            if content_type.partition(";")[0].strip().lower() in (
+                "",
+                *precompressed_generic_content_types,
+            ):
+                content_type = (
+                    mimetypes.guess_type(s3_key)[0] or "application/octet-stream"
+                )
+            return tuple(
+                (key, value) for key, value in headers if key != "content-type"
+            ) + (("content-type", content_type), ("content-encoding", content_encoding))
+
+        def open_cached(cached):
+            # Returns a function that returns the body of a range of the
+            # cached object, and a function to call if it's not needed
+            if "content" in cached:
+                return partial(body_from_memory_cache, cached["content"]), lambda: None
+            file = open(cached["path"], "rb")
+            return partial(body_from_disk_cache, file), file.close
+
+        def get_precondition_status(etag, last_modified):
+            # Conditional headers are passed to S3 if possible, but responses
+            # from the caches, or where S3 was asked about the cached version
+            # rather than the client's, are evaluated here, as per RFC 7232
+            etag, _ = unquote_etag(etag)
+            last_modified = parse_date(last_modified)
+            if_match = request.headers.get("if-match")
+            if_none_match = request.headers.get("if-none-match")
+            if_unmodified_since = parse_date(request.headers.get("if-unmodified-since"))
+            if_modified_since = parse_date(request.headers.get("if-modified-since"))
+
+            if if_match is not None:
+                if not parse_etags(if_match).contains(etag):
+                    return 412
+            elif if_unmodified_since and last_modified:
+                if last_modified > if_unmodified_since:
+                    return 412
+
+            if if_none_match is not None:
+                if parse_etags(if_none_match).contains_weak(etag):
+                    return 304
+            elif if_modified_since and last_modified:
+                if last_modified <= if_modified_since:
+                    return 304
+
+            return None
+
+        def is_range_allowed(etag, last_modified):
+            # S3 doesn't support If-Range, so it's emulated: the range only
+            # applies if the object has the exact ETag or date given. The
+            # comparison is strong, so a weak ETag never matches
+            if_range = parse_if_range_header(request.headers.get("if-range"))
+            if if_range.etag is not None:
+                _, is_weak = unquote_etag(request.headers["if-range"])
+                return not is_weak and if_range.etag == unquote_etag(etag)[0]
+            if if_range.date is not None:
+                return if_range.date == parse_date(last_modified)
+            return True
+
+        def response_precondition(status_code, headers):
+            # A 304 identifies the version of the object the client has. Other
+            # headers about the object would be removed by Werkzeug
+            response_headers = []
+            if status_code == 304:
+                response_headers = [
+                    (key, headers[key]) for key in ("etag",) if key in headers
+                ] + cache_control_headers
+            return Response(
+                body_empty([]), status=status_code, headers=response_headers
+            )
+
+        def response_from_cache(cached, cached_body, discard_cached, content_encoding):
+            size = cached["size"]
+            response_headers = list(cached["headers"]) + cache_control_headers
+            cached_headers = dict(cached["headers"])
+            is_cached_compressible = (
+                "content-encoding" not in cached_headers
+                and is_compressible(cached_headers, size)
+            )
+            if (
+                is_cached_compressible or precompressed_encodings
+            ) and "vary" not in cached_headers:
+                response_headers += vary_headers
+            etag = cached["etag"]
+            last_modified = cached_headers.get("last-modified")
+
+            precondition_status = get_precondition_status(etag, last_modified)
+            if precondition_status is not None:
+                discard_cached()
+                return response_precondition(precondition_status, cached_headers)
+
+            range_header = parse_range_header(request.headers.get("range"))
+
+            # Multiple ranges are treated as S3 treats them: ignored
+            if (
+                range_header is None
+                or len(range_header.ranges) != 1
+                or not is_range_allowed(etag, last_modified)
+            ):
+                start, stop = 0, size
+                status_code = 200
+            else:
+                byte_range = range_header.range_for_length(size)
+                if byte_range is None:
+                    discard_cached()
+                    return Response(
+                        body_empty([]),
+                        status=416,
+                        headers={"content-range": f"bytes */{size}"},
+                    )
+                start, stop = byte_range
+                status_code = 206
+                response_headers.append(
+                    ("content-range", f"bytes {start}-{stop - 1}/{size}")
+                )
+
+            logger.debug("Serving from cache: %s", status_code)
+            if request.method == "HEAD":
+                discard_cached()
+                body = body_empty([])
+            elif (
+                status_code == 200
+                and content_encoding is not None
+                and is_cached_compressible
+            ):
+                response_headers = list(
+                    compressed_headers(response_headers, content_encoding)
+                )
+                body = body_compressed(cached_body(start, stop), content_encoding)
+            else:
+                body = cached_body(start, stop)
+            if "content-encoding" not in dict(response_headers):
+                response_headers.append(("content-length", str(stop - start)))
+            return Response(
+                body,
+                status=status_code,
+                headers=response_headers,
+            )
+
+        def observe_first_byte(seconds, method):
+            observe_s3_first_byte(seconds, method)
+            request.environ["s3proxy.s3_first_byte_seconds"] = seconds
+
+        def request_object(request_kwargs, head, is_sibling=False):
+            # Returns the object, if any, with the status code and headers
+            # to respond with. Requests that don't need the body are made
+            # with head_object, which reports errors only by status. For a
+            # precompressed sibling, a 403 is kept, since it's what S3
+            # responds with for a missing key without s3:ListBucket
+            try:
+                with timed(observe_first_byte, "HEAD" if head else "GET"):
+                    s3_obj = (s3.head_object if head else get_object)(**request_kwargs)
+            except s3.exceptions.NoSuchKey:
+                return None, 404, {}
+            except ClientError as e:
+                metadata = e.response["ResponseMetadata"]
+                if metadata["HTTPStatusCode"] in (304, 404, 412, 416) or (
+                    is_sibling and metadata["HTTPStatusCode"] == 403
+                ):
+                    return None, metadata["HTTPStatusCode"], metadata["HTTPHeaders"]
+                return None, 500, {}
+            except Exception:  # don't want to expose anything to users
+                return None, 500, {}
+
+            metadata = s3_obj["ResponseMetadata"]
+            return s3_obj, metadata["HTTPStatusCode"], metadata["HTTPHeaders"]
+
+        def close_object(s3_obj):
+            if not is_head:
+                close_body(s3_obj["Body"])
+
+        def get_byte_ranges(ranges, size):
+            # Resolves each range against the size of the object, dropping
+            # any that can't be satisfied, and merges any that overlap or
+            # are adjacent, so no byte is sent twice
+            byte_ranges = []
+            for start, stop in ranges:
+                if start is None:
+                    byte_ranges.append((max(size - stop, 0), size))
+                else:
+                    stop = size if stop is None else min(stop, size)
+                    byte_ranges.append((start, stop))
+
+            merged = []
+            for start, stop in sorted(byte_ranges):
+                if start >= stop:
+                    continue
+                if merged and start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+                else:
+                    merged.append((start, stop))
+            return merged
+
+        def body_multipart(s3_key, etag, parts, footer):
+            # The request for each range is made before the previous range is
+            # sent, up to parallel_download_concurrency at once, but each
+            # range is streamed rather than held in memory
+            def get_range(start, stop):
+                return get_object(
+                    Bucket=bucket,
+                    Key=s3_key,
+                    Range=f"bytes={start}-{stop - 1}",
+                    IfMatch=etag,
+                )
+
+            parts_to_request = iter(parts)
+            requests_in_progress = deque()
+
+            def request_next_range():
+                try:
+                    part_header, start, stop = next(parts_to_request)
+                except StopIteration:
+                    return
+                requests_in_progress.append(
+                    (part_header, start, stop, gevent.spawn(get_range, start, stop))
+                )
+
+            try:
+                for _ in range(parallel_download_concurrency):
+                    request_next_range()
+
+                while requests_in_progress:
+                    part_header, start, stop, range_request = (
+                        requests_in_progress.popleft()
+                    )
+                    request_next_range()
+                    yield part_header
+                    with closing_body(range_request.get()["Body"]) as body:
+                        yield from body_upstream(body, stop - start)
+                yield footer
+            finally:
+                for _, _, _, range_request in requests_in_progress:
+                    range_request.kill()
+                    if range_request.successful():
+                        close_body(range_request.value["Body"])
+
+        def response_multi_range(request_kwargs, ranges):
+            # S3 doesn't support multiple ranges, so the size of the object is
+            # found first, and each range requested separately. Returns None
+            # if the request should instead be made for a single range, or for
+            # the whole object
+            s3_obj, status_code, s3_headers = request_object(request_kwargs, True)
+
+            if status_code in (304, 412):
+                return response_precondition(status_code, s3_headers)
+
+            if status_code != 200:
+                return Response(body_empty([]), status=status_code)
+
+            if not is_range_allowed(
+                s3_headers.get("etag"), s3_headers.get("last-modified")
+            ):
+                return None
+
+            size = s3_obj["ContentLength"]
+            byte_ranges = get_byte_ranges(ranges, size)
+
+            if not byte_ranges:
+                return Response(
+                    body_empty([]),
+                    status=416,
+                    headers={"content-range": f"bytes */{size}"},
+                )
+
+            if len(byte_ranges) == 1:
+                start, stop = byte_ranges[0]
+                request_kwargs["Range"] = f"bytes={start}-{stop - 1}"
+                return None
+
+            # Each range is a request to S3, so beyond a limit the range
+            # header is ignored, as RFC 7233 allows
+            if len(byte_ranges) > max_ranges:
+                return None
+
+            boundary = secrets.token_hex(16)
+            content_type_header = (
+                f'content-type: {s3_headers["content-type"]}\r\n'
+                if "content-type" in s3_headers
+                else ""
+            )
+            parts = [
+                (
+                    (
+                        f"\r\n--{boundary}\r\n{content_type_header}"
+                        f"content-range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+                    ).encode(),
+                    start,
+                    stop,
+                )
+                for start, stop in byte_ranges
+            ]
+            footer = f"\r\n--{boundary}--\r\n".encode()
+            content_length = sum(
+                len(part_header) + stop - start for part_header, start, stop in parts
+            ) + len(footer)
+
+            response_headers = [
+                (key, s3_headers[key])
+                for key in ("accept-ranges", "etag", "last-modified")
+                if key in s3_headers
+            ]
+            response_headers += [
+                ("content-type", f"multipart/byteranges; boundary={boundary}"),
+                ("content-length", str(content_length)),
+            ]
+            response_headers += cache_control_headers
+
+            if is_head:
+                body = body_empty([])
+            else:
+                body = body_multipart(
+                    request_kwargs["Key"], s3_obj["ETag"], parts, footer
+                )
+
+            logger.debug("Serving %s ranges", len(parts))
+            return Response(body, status=206, headers=response_headers)
+
+        def response_from_blocks(blocks, start, stop):
+            size = blocks[0]["size"]
+            if start >= size:
+                return Response(
+                    body_empty([]),
+                    status=416,
+                    headers={"content-range": f"bytes */{size}"},
+                )
+            stop = min(stop, size)
+            offset = blocks[0]["offset"]
+            data = b"".join(block["data"] for block in blocks)
+
+            logger.debug("Serving from read-ahead blocks")
+            response_headers = list(blocks[0]["headers"]) + cache_control_headers
+            response_headers += [
+                ("content-range", f"bytes {start}-{stop - 1}/{size}"),
+                ("content-length", str(stop - start)),
+            ]
+            return Response(
+                body_from_memory_cache(data, start - offset, stop - offset),
+                status=206,
+                headers=response_headers,
+            )
+
+        def response_from_read_ahead_cache(s3_key, start, stop):
+            # Returns None unless every block the range covers is cached, and
+            # they're all from the same version of the object
+            now = time.monotonic()
+            blocks = []
+            block_index = start // read_ahead_block_size
+            while True:
+                try:
+                    block = read_ahead_cache_get((s3_key, block_index))
+                except KeyError:
+                    return None
+                if block["fresh_until"] < now or (
+                    blocks and block["etag"] != blocks[0]["etag"]
+                ):
+                    return None
+                blocks.append(block)
+                block_stop = block["offset"] + len(block["data"])
+                if block_stop >= min(stop, block["size"]):
+                    break
+                block_index += 1
+
+            etag = blocks[0]["etag"]
+            last_modified = dict(blocks[0]["headers"]).get("last-modified")
+            precondition_status = get_precondition_status(etag, last_modified)
+            if precondition_status is not None:
+                return response_precondition(precondition_status, {"etag": etag})
+            if not is_range_allowed(etag, last_modified):
+                return None
+
+            return response_from_blocks(blocks, start, stop)
+
+        def response_read_ahead(s3_obj, s3_key, s3_headers, start, stop):
+            # The response is for whole blocks, so is split into them and
+            # cached, and the range requested served from them
+            content_range = parse_content_range_header(s3_headers["content-range"])
+            with closing_body(s3_obj["Body"]):
+                data = s3_obj["Body"].read()
+            headers = tuple(
+                (key, s3_headers[key])
+                for key in ("accept-ranges", "content-type", "etag", "last-modified")
+                if key in s3_headers
+            )
+            fresh_until = time.monotonic() + read_ahead_cache_ttl
+
+            blocks = []
+            for offset in range(
+                content_range.start, content_range.stop, read_ahead_block_size
+            ):
+                data_start = offset - content_range.start
+                data_stop = data_start + read_ahead_block_size
+                block = {
+                    "data": data[data_start:data_stop],
+                    "offset": offset,
+                    "etag": s3_obj["ETag"],
+                    "size": content_range.length,
+                    "headers": headers,
+                    "fresh_until": fresh_until,
+                }
+                read_ahead_cache_set((s3_key, offset // read_ahead_block_size), block)
+                blocks.append(block)
+
+            return response_from_blocks(blocks, start, stop)
+
+        def get_listing_page(prefix, continuation_token, max_keys):
+            # The folders and objects directly under the prefix, from one page
+            # of a delimited listing. Pages are cached briefly, so a folder
+            # being browsed by many users is listed once per TTL per process
+            cache_key = (prefix, continuation_token, max_keys)
+            try:
+                page, fresh_until = listing_cache_get(cache_key)
+            except KeyError:
+                fresh_until = 0
+            if time.monotonic() < fresh_until:
+                return page
+
+            continuation_kwargs = (
+                {"ContinuationToken": continuation_token} if continuation_token else {}
+            )
+            response = s3.list_objects_v2(
+                Bucket=bucket,
+                Prefix=key_prefix + prefix,
+                Delimiter="/",
+                MaxKeys=max_keys,
+                **continuation_kwargs,
+            )
+            page = {
+                "folders": [
+                    common_prefix["Prefix"].removeprefix(key_prefix)
+                    for common_prefix in response.get("CommonPrefixes", [])
+                ],
+                # Without the marker object some tools create for a folder
+                "objects": [
+                    {
+                        "key": s3_obj["Key"].removeprefix(key_prefix),
+                        "size": s3_obj["Size"],
+                        "last_modified": s3_obj["LastModified"].isoformat(),
+                        "etag": s3_obj["ETag"],
+                    }
+                    for s3_obj in response.get("Contents", [])
+                    if s3_obj["Key"] != key_prefix + prefix
+                ],
+                "next_continuation_token": response.get("NextContinuationToken"),
+            }
+            listing_cache_set(cache_key, (page, time.monotonic() + listing_cache_ttl))
+            return page
+
+        def body_listing_html(prefix, page, next_query):
+            # Links are relative to the folder, so work under any mount point
+            def link(key):
+                name = key.removeprefix(prefix)
+                return (
+                    f'<a href="{html.escape(urllib.parse.quote(name))}">'
+                    f"{html.escape(name)}</a>"
+                )
+
+            title = html.escape("/" + prefix)
+            yield (
+                "<!DOCTYPE html>\n<html>\n<head>\n"
+                '<meta charset="utf-8">\n'
+                f"<title>{title}</title>\n</head>\n<body>\n"
+                f"<h1>{title}</h1>\n<ul>\n"
+            )
+            if prefix:
+                yield '<li><a href="../">../</a></li>\n'
+            for folder in page["folders"]:
+                yield f"<li>{link(folder)}</li>\n"
+            for s3_obj in page["objects"]:
+                yield (
+                    f"<li>{link(s3_obj['key'])} {s3_obj['size']} bytes, "
+                    f"{html.escape(s3_obj['last_modified'])}</li>\n"
+                )
+            yield "</ul>\n"
+            if next_query is not None:
+                yield f'<p><a href="?{html.escape(next_query)}">Next page</a></p>\n'
+            if zip_path:
+                zip_query = urllib.parse.urlencode({"prefix": prefix})
+                yield (
+                    f'<p><a href="/{html.escape(zip_path)}?{html.escape(zip_query)}">'
+                    "Download as ZIP</a></p>\n"
+                )
+            yield "</body>\n</html>\n"
+
+        def response_listing(prefix):
+            # One page per response, of at most listing_page_size entries, so
+            # large folders are fetched from S3 only as they're browsed
+            continuation_token = request.args.get("continuation-token")
+            try:
+                max_keys = int(request.args.get("max-keys", listing_page_size))
+            except ValueError:
+                return Response(b"", 400)
+            max_keys = min(max(max_keys, 1), listing_page_size)
+
+            try:
+                page = get_listing_page(prefix, continuation_token, max_keys)
+            except ClientError as e:
+                # Such as an invalid continuation token
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] == 400:
+                    return Response(b"", 400)
+                logger.exception("Unable to list objects")
+                return Response(b"", 500)
+            except Exception:  # don't want to expose anything to users
+                logger.exception("Unable to list objects")
+                return Response(b"", 500)
+
+            # S3 has no folders, just keys with a common prefix, so one with
+            # nothing in it doesn't exist
+            if (
+                prefix
+                and not continuation_token
+                and not (page["folders"] or page["objects"])
+            ):
+                return Response(b"", 404)
+
+            next_query = (
+                urllib.parse.urlencode(
+                    {
+                        "continuation-token": page["next_continuation_token"],
+                        **(
+                            {"max-keys": max_keys} if "max-keys" in request.args else {}
+                        ),
+                    }
+                )
+                if page["next_continuation_token"] is not None
+                else None
+            )
+            headers = [("vary", "accept")]
+            if (
+                request.accept_mimetypes.best_match(["application/json", "text/html"])
+                == "text/html"
+            ):
+                # Joined, since each chunk of a response is a separate write
+                return Response(
+                    "".join(body_listing_html(prefix, page, next_query)),
+                    headers=headers + [("content-type", "text/html; charset=utf-8")],
+                )
+            return Response(
+                json.dumps({"prefix": prefix, **page}),
+                headers=headers + [("content-type", "application/json")],
+            )
+
+        is_head = request.method == "HEAD"
+
+        # Paths of folders are listed rather than requested from S3, with the
+        # root path mapped to key_prefix itself
+        if enable_listing and path.endswith("/"):
+            return response_listing("" if path == "/" else path)
+
+        s3_key = key_prefix + path
+        request_kwargs = {"Bucket": bucket, "Key": s3_key}
         for key in proxied_request_headers:
             if key in request.headers:
                 camel_key = camel_to_pascal_case(key)
                 request_kwargs[camel_key] = request.headers[key]
 
-        try:
-            s3_obj = s3.get_object(**request_kwargs)
-            status_code = s3_obj["ResponseMetadata"]["HTTPStatusCode"]
-        except s3.exceptions.NoSuchKey:
-            status_code = 404
-        except Exception:  # don't want to expose anything to users
-            status_code = 500
+        ranges = parse_byte_ranges(request.headers.get("range"))
+        is_multi_range = ranges is not None and len(ranges) > 1
+
+        # Whole objects are compressed if the client accepts it, but ranges
+        # are always of the object as stored
+        content_encoding = (
+            request.accept_encodings.best_match(compression_encodings)
+            if compression_content_types
+            and not is_head
+            and "range" not in request.headers
+            else None
+        )
+
+        # A precompressed sibling is served in place of the object if the
+        # client accepts its encoding, including from the caches
+        precompressed_encoding = (
+            get_precompressed_encoding(s3_key)
+            if precompressed_encodings and "range" not in request.headers
+            else None
+        )
+        if precompressed_encoding is not None:
+            object_s3_key = s3_key
+            s3_key += precompressed_suffixes[precompressed_encoding]
+            request_kwargs["Key"] = s3_key
+            content_encoding = None
+
+        # Whether to redirect is decided by a HEAD request, rather than a GET
+        # that would be closed unread and its connection lost if redirected,
+        # and the decision is reused for as long as the presigned URL would
+        # be. Siblings aren't redirected to, since S3 wouldn't respond with
+        # their content-encoding
+        is_redirect_allowed = (
+            redirect_min_size and not is_head and precompressed_encoding is None
+        )
+        if is_redirect_allowed:
+            try:
+                presigned_url, reuse_until = presigned_url_cache_get(s3_key)
+            except KeyError:
+                presigned_url, reuse_until = None, 0
+            if time.monotonic() >= reuse_until:
+                head_obj, head_status_code, head_headers = request_object(
+                    {"Bucket": bucket, "Key": s3_key}, True
+                )
+                if head_status_code == 200 and is_redirectable(
+                    head_headers, head_obj["ContentLength"]
+                ):
+                    return response_redirect(s3_key)
+                if head_status_code == 200:
+                    presigned_url_cache_set(
+                        s3_key, (None, time.monotonic() + presigned_url_expiry * 0.8)
+                    )
+            elif presigned_url is not None:
+                return response_redirect(s3_key)
+
+        # Each cache is always empty if not enabled, and the body of a
+        # cached object is opened before S3 is asked, in case it's evicted.
+        # Compressed objects are cached in memory alongside the originals.
+        # Requests for multiple ranges bypass the caches
+        cached = None
+        for cache_get, cache_key, cache_max_age in (
+            ()
+            if is_multi_range
+            else (
+                (
+                    (
+                        (
+                            memory_cache_get,
+                            (s3_key, content_encoding),
+                            memory_cache_max_age,
+                        ),
+                    )
+                    if content_encoding is not None
+                    else ()
+                )
+                + (
+                    (memory_cache_get, s3_key, memory_cache_max_age),
+                    (disk_cache_get, s3_key, disk_cache_max_age),
+                )
+            )
+        ):
+            try:
+                cached = cache_get(cache_key)
+            except KeyError:
+                continue
+            cached_body, discard_cached = open_cached(cached)
+            if time.monotonic() < cached["fresh_until"]:
+                return response_from_cache(
+                    cached, cached_body, discard_cached, content_encoding
+                )
+            request_kwargs["IfNoneMatch"] = cached["etag"]
+            break
+
+        if cached is None:
+            for key in conditional_request_headers:
+                value = request.headers.get(key)
+                # Invalid dates must be ignored, rather than rejected by S3
+                if value is None or (
+                    key.endswith("-since") and parse_date(value) is None
+                ):
+                    continue
+                # Clients have weak ETags of compressed objects, which match
+                # the object's ETag since If-None-Match is a weak comparison
+                if key == "if-none-match" and compression_content_types:
+                    etags = parse_etags(value)
+                    if not etags.star_tag:
+                        value = ", ".join(
+                            quote_etag(etag) for etag in etags.as_set(include_weak=True)
+                        )
+                request_kwargs[camel_to_pascal_case(key)] = value
+
+        if is_multi_range:
+            del request_kwargs["Range"]
+            multi_range_response = response_multi_range(request_kwargs, ranges)
+            if multi_range_response is not None:
+                return multi_range_response
+
+        # Small ranges of objects not otherwise cached are requested as the
+        # whole blocks they're in, and the blocks kept briefly, since media
+        # players tend to make many small requests for sequential ranges
+        read_ahead_range = None
+        if (
+            read_ahead_block_size
+            and cached is None
+            and not is_head
+            and ranges is not None
+            and len(ranges) == 1
+            and ranges[0][0] is not None
+            and ranges[0][1] is not None
+            and ranges[0][1] - ranges[0][0] <= read_ahead_block_size
+        ):
+            read_ahead_range = ranges[0]
+            read_ahead_response = response_from_read_ahead_cache(
+                s3_key, *read_ahead_range
+            )
+            if read_ahead_response is not None:
+                return read_ahead_response
+            start, stop = read_ahead_range
+            block_size = read_ahead_block_size
+            block_start = start // block_size * block_size
+            block_stop = ((stop - 1) // block_size + 1) * block_size
+            request_kwargs["Range"] = f"bytes={block_start}-{block_stop - 1}"
+
+        # Responses that may be large enough to fetch in parts are requested
+        # from S3 for just their first part, so it can be read in full and
+        # its connection returned to the pool, rather than closed with the
+        # rest unread. The response to the client is still for what it asked
+        parts_range = None
+        is_whole_in_parts = False
+        if parallel_download_min_size and not is_head and read_ahead_range is None:
+            requested_ranges = parse_byte_ranges(request_kwargs.get("Range"))
+            is_whole_in_parts = requested_ranges is None
+            if is_whole_in_parts:
+                parts_range = (0, None)
+            elif len(requested_ranges) == 1 and requested_ranges[0][0] is not None:
+                parts_range = requested_ranges[0]
+        if parts_range is not None:
+            parts_start, parts_stop = parts_range
+            first_part_stop = parts_start + parallel_download_part_size
+            if parts_stop is not None:
+                first_part_stop = min(first_part_stop, parts_stop)
+            request_kwargs["Range"] = f"bytes={parts_start}-{first_part_stop - 1}"
+
+        is_sibling = precompressed_encoding is not None
+        s3_obj, status_code, s3_headers = request_object(
+            request_kwargs, is_head, is_sibling
+        )
 
-        logger.debug(f"Status code: {status_code}")
+        # An empty object has no first part, so its range can't be satisfied
+        is_empty_in_parts = is_whole_in_parts and status_code == 416
+        is_range_ignored = (
+            status_code == 206
+            and "range" in request.headers
+            and not is_range_allowed(
+                s3_headers.get("etag"), s3_headers.get("last-modified")
+            )
+        )
+        if is_empty_in_parts or is_range_ignored:
+            if s3_obj is not None:
+                close_object(s3_obj)
+            del request_kwargs["Range"]
+            parts_range = None
+            s3_obj, status_code, s3_headers = request_object(
+                request_kwargs, is_head, is_sibling
+            )
+
+        if parts_range is not None and status_code == 206:
+            first_part_size = s3_obj["ContentLength"]
+            size = parse_content_range_header(s3_headers["content-range"]).length
+            parts_stop = size if parts_stop is None else min(parts_stop, size)
+            s3_headers = {**s3_headers, "content-length": str(parts_stop - parts_start)}
+            if is_whole_in_parts:
+                status_code = 200
+                del s3_headers["content-range"]
+            else:
+                s3_headers["content-range"] = (
+                    f"bytes {parts_start}-{parts_stop - 1}/{size}"
+                )
+            s3_obj["ContentLength"] = parts_stop - parts_start
+        else:
+            parts_range = None
+
+        logger.debug("Status code: %s", status_code)
+
+        if cached is not None:
+            if status_code == 304:
+                cached["fresh_until"] = time.monotonic() + cache_max_age
+                return response_from_cache(
+                    cached, cached_body, discard_cached, content_encoding
+                )
+            discard_cached()
+            if status_code in (200, 206, 403, 404):
+                memory_cache_delete(s3_key)
+                disk_cache_delete(s3_key)
+                for encoding in compression_encodings:
+                    memory_cache_delete((s3_key, encoding))
+
+        # The sibling has been deleted since it was found, or can't be read,
+        # so the object itself is served, with the sibling's cached existence
+        # replaced so it isn't looked for again until it expires
+        if is_sibling and status_code in (403, 404):
+            precompressed_cache_set(
+                s3_key, (False, time.monotonic() + precompressed_cache_ttl)
+            )
+            return proxy.__wrapped__(path)
+
+        if cached is not None and status_code in (200, 206):
+            precondition_status = get_precondition_status(
+                s3_headers.get("etag"), s3_headers.get("last-modified")
+            )
+            if precondition_status is not None:
+                close_object(s3_obj)
+                status_code = precondition_status
+
+        if status_code in (304, 412):
+            return response_precondition(status_code, s3_headers)
+
+        if read_ahead_range is not None and status_code == 206:
+            return response_read_ahead(s3_obj, s3_key, s3_headers, *read_ahead_range)
 
         if status_code in (200, 206):
-            response_headers = tuple(
+            object_headers = tuple(
                 (
-                    (key, s3_obj["ResponseMetadata"]["HTTPHeaders"][key])
+                    (key, s3_headers[key])
                     for key in proxied_response_headers
-                    if key in s3_obj["ResponseMetadata"]["HTTPHeaders"]
+                    if key in s3_headers
+                )
+            )
+            if precompressed_encoding is not None:
+                object_headers = precompressed_headers(
+                    object_headers, object_s3_key, precompressed_encoding
                 )
+            response_headers = object_headers + tuple(cache_control_headers)
+
+            content_length = s3_obj["ContentLength"]
+            is_object_compressible = compression_content_types and is_compressible(
+                s3_headers, content_length
+            )
+            if is_object_compressible or precompressed_encodings:
+                response_headers += tuple(vary_headers)
+            if is_head:
+                body = body_empty([])
+            elif parts_range is not None and first_part_size < content_length:
+                body = body_parts(
+                    s3_obj["Body"],
+                    s3_key,
+                    s3_obj["ETag"],
+                    parts_start,
+                    first_part_size,
+                    parts_stop,
+                )
+            elif stream_buffer_size:
+                body = body_buffered(s3_obj["Body"], content_length)
+            else:
+                body = body_upstream(s3_obj["Body"], content_length)
+            is_memory_cacheable = (
+                memory_cache_max_size and content_length <= memory_cache_max_object_size
             )
+            is_disk_cacheable = (
+                disk_cache_dir is not None
+                and content_length <= disk_cache_max_object_size
+            )
+            if status_code != 200 or is_head:
+                body_to_cache = None
+            elif is_memory_cacheable:
+                body_to_cache = body_to_memory_cache
+            elif is_disk_cacheable:
+                body_to_cache = body_to_disk_cache
+            else:
+                body_to_cache = None
+
+            cache_headers = tuple(
+                (key, value)
+                for key, value in object_headers
+                if key not in ("content-length", "content-range", "date")
+            )
+            if body_to_cache is not None:
+                body = body_to_cache(
+                    body,
+                    s3_key,
+                    s3_obj["ETag"],
+                    cache_headers,
+                    content_length,
+                )
+
+            if status_code == 200 and content_encoding and is_object_compressible:
+                response_headers = compressed_headers(
+                    response_headers, content_encoding
+                )
+                body = body_compressed(body, content_encoding)
+                if memory_cache_max_size:
+                    body = body_to_memory_cache(
+                        body,
+                        (s3_key, content_encoding),
+                        s3_obj["ETag"],
+                        compressed_headers(
+                            cache_headers + tuple(vary_headers), content_encoding
+                        ),
+                        None,
+                    )
+
+            if stream_min_throughput and not is_head:
+                body = body_with_min_throughput(body, request.environ["CLIENT_SOCKET"])
 
             downstream_response = Response(
-                body_upstream(s3_obj["Body"]),
+                body,
                 status=status_code,
                 headers=response_headers,
             )
-            downstream_response.call_on_close(s3_obj["Body"].close)
+            downstream_response.call_on_close(partial(close_object, s3_obj))
         else:
             downstream_response = Response(body_empty([]), status=status_code)
         return downstream_response
 
+    @authenticate_by_sso
+    def zip_download():
+        logger.debug("Attempt to download zip: %s", request)
+
+        def get_keys():
+            # The keys of the members, relative to key_prefix, in the order
+            # given or listed, without "folder" markers. Listing stops once
+            # there are more than zip_max_keys, so too many can be detected
+            keys = request.args.getlist("key")
+            prefix = request.args.get("prefix")
+            if prefix is None:
+                return keys
+
+            for page in s3.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket, Prefix=key_prefix + prefix
+            ):
+                for s3_obj in page.get("Contents", []):
+                    key = s3_obj["Key"].removeprefix(key_prefix)
+                    if not key.endswith("/"):
+                        keys.append(key)
+                if len(keys) > zip_max_keys:
+                    break
+            return keys
+
+        def get_member(key):
+            try:
+                return get_object(Bucket=bucket, Key=key_prefix + key)
+            except ClientError as e:
+                # Deleted since being listed, or never existed
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] in (403, 404):
+                    return None
+                raise
+
+        def get_member_name(key):
+            # Keys can have empty, "." or ".." segments that would be written
+            # outside the folder being extracted to by some tools, so they're
+            # removed from the names of members
+            return "/".join(
+                segment for segment in key.split("/") if segment not in ("", ".", "..")
+            )
+
+        def body_zip(keys):
+            # Up to zip_concurrency members are requested from S3 ahead of the
+            # one being written, but only their bodies are read as they're
+            # written, so memory use is constant however large the members.
+            # Members are deflated, at zlib's default level since zipfile has
+            # no public way to set the level of a member given as a ZipInfo.
+            # Stored members would save that CPU, but can't be used, since the
+            # archive isn't seekable so their sizes follow their data, which
+            # some readers such as Java's ZipInputStream don't support
+            writer = ChunkWriter()
+            keys = iter(keys)
+            members = deque()
+
+            def get_next_member():
+                try:
+                    key = next(keys)
+                except StopIteration:
+                    return
+                members.append((key, gevent.spawn(get_member, key)))
+
+            try:
+                for _ in range(zip_concurrency):
+                    get_next_member()
+
+                with zipfile.ZipFile(writer, "w") as archive:
+                    while members:
+                        key, member = members.popleft()
+                        s3_obj = member.get()
+                        get_next_member()
+                        if s3_obj is None:
+                            continue
+
+                        name = get_member_name(key)
+                        if not name:
+                            close_body(s3_obj["Body"])
+                            continue
+
+                        # A ZIP file can only store dates from 1980 to 2107
+                        member_info = zipfile.ZipInfo(
+                            name,
+                            min(
+                                max(
+                                    s3_obj["LastModified"].timetuple()[:6],
+                                    (1980, 1, 1, 0, 0, 0),
+                                ),
+                                (2107, 12, 31, 23, 59, 59),
+                            ),
+                        )
+                        member_info.file_size = s3_obj["ContentLength"]
+                        member_info.compress_type = zipfile.ZIP_DEFLATED
+                        with closing_body(s3_obj["Body"]), archive.open(
+                            member_info, "w"
+                        ) as member_file:
+                            for chunk in s3_obj["Body"].iter_chunks(
+                                stream_max_chunk_size
+                            ):
+                                member_file.write(chunk)
+                                yield from writer.pop_chunks()
+                        yield from writer.pop_chunks()
+                yield from writer.pop_chunks()
+            finally:
+                gevent.killall([member for _, member in members])
+                for _, member in members:
+                    if member.successful() and member.value is not None:
+                        close_body(member.value["Body"])
+
+        if "key" not in request.args and "prefix" not in request.args:
+            return Response(b"", 400)
+
+        try:
+            keys = get_keys()
+        except Exception:  # don't want to expose anything to users
+            logger.exception("Unable to list objects")
+            return Response(b"", 500)
+
+        if len(keys) > zip_max_keys:
+            return Response(b"", 400)
+
+        filename = (
+            request.args.get("prefix", "").rstrip("/").rpartition("/")[2] or "download"
+        )
+        return Response(
+            body_zip(keys),
+            headers={
+                "content-type": "application/zip",
+                "content-disposition": "attachment; filename*=UTF-8''"
+                + urllib.parse.quote(filename + ".zip"),
+            },
+        )
+
     def redis_get(key):
-        value_bytes = redis_client.get(f"{redis_prefix}__{key}")
+        with timed(observe_redis, "get"):
+            value_bytes = redis_client.get(f"{redis_prefix}__{key}")
         if value_bytes is None:
             raise KeyError(key)
         return value_bytes.decode()
 
+    def redis_get_many_with_ttl(keys):
+        # Returns a (value, seconds to expiry) pair for each key, with a value
+        # of None rather than raising if a key is missing, since whether each
+        # is missing is a normal part of the response
+        prefixed_keys = [f"{redis_prefix}__{key}" for key in keys]
+        with timed(observe_redis, "get_many_with_ttl"), redis_client.pipeline(
+            transaction=False
+        ) as pipe:
+            pipe.mget(prefixed_keys)
+            for key in prefixed_keys:
+                pipe.pttl(key)
+            values, *ttls = pipe.execute()
+        return [
+            (None if value_bytes is None else value_bytes.decode(), ttl / 1000)
+            for value_bytes, ttl in zip(values, ttls)
+        ]
+
     def redis_set(key, value, ex):
-        redis_client.set(f"{redis_prefix}__{key}", value.encode(), ex=ex)
+        with timed(observe_redis, "set"):
+            redis_client.set(f"{redis_prefix}__{key}", value.encode(), ex=ex)
+
+    def redis_set_if_not_exists(key, value, px):
+        with timed(observe_redis, "set_if_not_exists"):
+            return bool(
+                redis_client.set(
+                    f"{redis_prefix}__{key}", value.encode(), px=px, nx=True
+                )
+            )
+
+    def redis_set_many(items):
+        with timed(observe_redis, "set_many"), redis_client.pipeline(
+            transaction=False
+        ) as pipe:
+            for key, value, ex in items:
+                pipe.set(f"{redis_prefix}__{key}", value.encode(), ex=ex)
+            pipe.execute()
+
+    def metrics():
+        return Response(
+            format_metrics(
+                (collect() for collect in metrics_collectors), metrics_labels
+            ),
+            headers={"content-type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    # Sampled from a native thread of gevent's threadpool, which sleeps with
+    # the unpatched sleep, since gevent's would yield to a hub of its own
+    main_thread_id = monkey.get_original("_thread", "get_ident")()
+    native_sleep = monkey.get_original("time", "sleep")
+
+    def profile():
+        # Only for those with the token, since the stacks reveal the code
+        authorization = request.headers.get("authorization", "")
+        if not secrets.compare_digest(
+            authorization.encode(), f"Bearer {profiling_token}".encode()
+        ):
+            return Response(b"", 403)
+        try:
+            seconds = float(request.args.get("seconds", "10"))
+        except ValueError:
+            return Response(b"", 400)
+        seconds = min(max(seconds, 0), profiling_max_seconds)
+
+        stacks = gevent.get_hub().threadpool.apply(
+            sample_stacks,
+            (main_thread_id, seconds, profiling_interval, native_sleep),
+        )
+        return Response(
+            stacks,
+            headers={
+                "content-type": "text/plain; charset=utf-8",
+                "content-disposition": (
+                    f"attachment; filename=profile-{os.getpid()}.txt"
+                ),
+            },
+        )
+
+    def record_response_started(response):
+        # The stream phase is after the headers are sent, so can't be in them,
+        # and is only in the access log
+        app_seconds = time.monotonic() - request.environ["s3proxy.started_at"]
+        request.environ["s3proxy.app_seconds"] = app_seconds
+        if enable_server_timing:
+            response.headers["server-timing"] = ", ".join(
+                f'{name};desc="{description}";dur={seconds * 1000:.1f}'
+                for name, description, key in server_timings
+                if (seconds := request.environ.get(key)) is not None
+            )
+        return response
+
+    def measure_responses(wsgi_app):
+        # Each response is measured until the end of its body is sent to the
+        # client, or sending it fails
+        def _measure_responses(environ, start_response):
+            nonlocal requests_in_progress
+            status = "500"
+
+            def _start_response(status_line, headers, exc_info=None):
+                nonlocal status
+                status = status_line.partition(" ")[0]
+                return start_response(status_line, headers, exc_info)
+
+            requests_in_progress += 1
+            start = time.monotonic()
+            num_bytes = 0
+            body = ()
+            try:
+                body = wsgi_app(environ, _start_response)
+                for chunk in body:
+                    num_bytes += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+                requests_in_progress -= 1
+                observe_response_duration(time.monotonic() - start, status)
+                observe_response_bytes(num_bytes, status)
+
+        return _measure_responses
 
     class RequestLinePathHandler(WSGIHandler):
         # The default WSGIHandler does not preseve a trailing question mark
-        # from the original request-line path sent by the client
+        # from the original request-line path sent by the client. The socket
+        # is also exposed, so slow clients can be disconnected, which
+        # interrupts the write to them with EBADF
+        ignored_socket_errors = WSGIHandler.ignored_socket_errors + (errno.EBADF,)
+
         def get_environ(self):
             return {
                 **super().get_environ(),
                 "REQUEST_LINE_PATH": self.path,
+                "CLIENT_SOCKET": self.socket,
+                "s3proxy.started_at": time.monotonic(),
             }
 
+        def handle_one_request(self):
+            # Cleared so a malformed request on a kept-alive connection isn't
+            # logged with the details of the request before it
+            self.environ = None
+            self.command = None
+            self.path = None
+            return super().handle_one_request()
+
+        def log_request(self):
+            # A JSON line per request in place of the default access log, with
+            # successful requests sampled. The query string is left out since
+            # it can contain SSO codes, and sessions are identified by a hash.
+            # Requests rejected before reaching the app, such as those with a
+            # malformed request line, have no environ, so are logged with what
+            # was parsed of them
+            if self.environ is not None:
+                environ = self.environ
+                status = self.code or 0
+            else:
+                environ = {}
+                status = int(str(self.status).split()[0])
+            if not logger.isEnabledFor(logging.INFO):
+                return
+            if status < 400 and random.random() >= access_log_sample_rate:
+                return
+
+            session_id = environ.get("s3proxy.session_id")
+            access_log = {
+                "time": datetime.utcfromtimestamp(self.time_start).isoformat() + "Z",
+                "method": environ.get("REQUEST_METHOD", self.command),
+                "path": (
+                    self.path.partition("?")[0] if self.path is not None else None
+                ),
+                "status": status,
+                "bytes": self.response_length,
+                "duration": self.time_finish - self.time_start,
+                "s3_first_byte": environ.get("s3proxy.s3_first_byte_seconds"),
+                "auth_duration": environ.get("s3proxy.auth_seconds"),
+                "stream": (
+                    time.monotonic()
+                    - environ["s3proxy.started_at"]
+                    - environ["s3proxy.app_seconds"]
+                    if "s3proxy.app_seconds" in environ
+                    else None
+                ),
+                "auth": environ.get("s3proxy.auth_outcome"),
+                "session": (
+                    hashlib.sha256(session_id.encode()).hexdigest()[:16]
+                    if session_id is not None
+                    else None
+                ),
+                "remote_addr": environ.get(
+                    "REMOTE_ADDR",
+                    (
+                        self.client_address[0]
+                        if isinstance(self.client_address, tuple)
+                        else self.client_address
+                    ),
+                ),
+                "forwarded_for": environ.get("HTTP_X_FORWARDED_FOR"),
+            }
+            if status < 400:
+                access_log["sample_rate"] = access_log_sample_rate
+            logger.info(json.dumps(access_log))
+
     app = Flask("app")
 
     if enable_xray:
@@ -406,18 +2686,95 @@ def proxy_app(
         )
         sentry_sdk.set_tag("instance_id", instance_id)
 
+    # The static rules take precedence over the path rule. Metrics, like the
+    # healthcheck, are served without authentication, and profiles need a
+    # token rather than SSO
+    if zip_path:
+        app.add_url_rule(f"/{zip_path}", view_func=zip_download)
+    if metrics_path:
+        app.add_url_rule(f"/{metrics_path}", view_func=metrics)
+        app.wsgi_app = measure_responses(app.wsgi_app)
+    if profiling_path and profiling_token:
+        app.add_url_rule(f"/{profiling_path}", view_func=profile)
+    app.after_request(record_response_started)
     app.add_url_rule("/", view_func=proxy, defaults={"path": "/"})
     app.add_url_rule("/<path:path>", view_func=proxy)
-    server = WSGIServer(("0.0.0.0", port), app, handler_class=RequestLinePathHandler)
+    # With multiple workers, each has its own listening socket on the same
+    # port, and the kernel distributes connections between them
+    if reuse_port:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(("0.0.0.0", port))
+        listener.listen(WSGIServer.backlog)
+        listener.setblocking(False)
+    else:
+        listener = ("0.0.0.0", port)
+
+    server = WSGIServer(
+        listener,
+        app,
+        handler_class=RequestLinePathHandler,
+        spawn=(
+            Pool(max_concurrent_connections)
+            if max_concurrent_connections is not None
+            else "default"
+        ),
+    )
+    # With a pool, the server kills in-progress requests on stop after this
+    # timeout. None waits for them to complete, as without a pool
+    server.stop_timeout = None
 
     return start, stop
 
 
+def run_workers(logger, num_workers, serve):
+    """Calls serve in num_workers forked processes, restarting any that exit
+    unexpectedly. SIGTERM is forwarded to the workers, and this returns once
+    they have all completed their in-progress requests and exited"""
+    worker_pids = set()
+    stopping = False
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                serve()
+                status = 0
+            except Exception:
+                logger.exception("Worker failed")
+            finally:
+                os._exit(status)
+        worker_pids.add(pid)
+
+    def stop(_, __):
+        nonlocal stopping
+        stopping = True
+        for pid in worker_pids:
+            os.kill(pid, signal.SIGTERM)
+
+    for _ in range(num_workers):
+        start_worker()
+
+    gevent.signal.signal(signal.SIGTERM, stop)
+
+    while worker_pids:
+        pid, status = os.waitpid(-1, 0)
+        worker_pids.discard(pid)
+        if not stopping:
+            logger.error("Worker %s exited with status %s, restarting", pid, status)
+            # Avoid a tight loop if workers fail on startup
+            gevent.sleep(1)
+            start_worker()
+
+
 def main():
+    log_level = os.environ.get("LOG_LEVEL", "DEBUG").upper()
     stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(logging.DEBUG)
+    stdout_handler.setLevel(log_level)
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(log_level)
     logger.addHandler(stdout_handler)
 
     def _bool(value):
@@ -426,6 +2783,12 @@ def main():
     enable_sentry_tracing = _bool(os.environ.get("SENTRY_ENABLE_TRACING"))
     enable_xray = _bool(os.environ.get("ENABLE_XRAY"))
 
+    def _int_or_none(value):
+        return int(value) if value else None
+
+    def _float_or_none(value):
+        return float(value) if value else None
+
     s3_use_local = os.environ.get("S3_USE_LOCAL", False)
     if s3_use_local and s3_use_local not in [0, "0", "false", "False"]:
         s3_use_local = True
@@ -442,34 +2805,142 @@ def main():
     environment_name = os.environ.get("COPILOT_ENVIRONMENT_NAME", os.environ.get("APP_ENV", "undefined"))
     instance_id = get_ecs_task_id() or "undefined"
 
-    start, stop = proxy_app(
-        logger,
-        int(os.environ["PORT"]),
-        redis_url,
-        os.environ["SSO_URL"],
-        os.environ["SSO_CLIENT_ID"],
-        os.environ["SSO_CLIENT_SECRET"],
-        int(os.environ.get("SSO_TOKEN_CHECK_GRACE_PERIOD", "3600")),
-        os.environ["AWS_S3_BUCKET"],
-        os.environ["AWS_DEFAULT_REGION"],
-        os.environ["AWS_S3_HEALTHCHECK_KEY"],
-        os.environ.get("KEY_PREFIX", None),
-        environment_name,
-        instance_id,
-        os.environ.get("AWS_ACCESS_KEY_ID", None),
-        os.environ.get("AWS_SECRET_ACCESS_KEY", None),
-        s3_use_local,
-        os.environ.get("S3_ENDPOINT_URL", None),
-        os.environ.get("SSO_URL_INTERNAL", os.environ["SSO_URL"]),
-        enable_xray,
-        os.environ.get("SENTRY_DSN", None),
-        enable_sentry_tracing,
-        float(os.environ.get("SENTRY_TRACES_SAMPLE_RATE", "0.0"))
-    )
+    def serve(reuse_port):
+        start, stop = proxy_app(
+            logger,
+            int(os.environ["PORT"]),
+            redis_url,
+            os.environ["SSO_URL"],
+            os.environ["SSO_CLIENT_ID"],
+            os.environ["SSO_CLIENT_SECRET"],
+            int(os.environ.get("SSO_TOKEN_CHECK_GRACE_PERIOD", "3600")),
+            os.environ["AWS_S3_BUCKET"],
+            os.environ["AWS_DEFAULT_REGION"],
+            os.environ["AWS_S3_HEALTHCHECK_KEY"],
+            os.environ.get("KEY_PREFIX", None),
+            environment_name,
+            instance_id,
+            os.environ.get("AWS_ACCESS_KEY_ID", None),
+            os.environ.get("AWS_SECRET_ACCESS_KEY", None),
+            s3_use_local,
+            os.environ.get("S3_ENDPOINT_URL", None),
+            os.environ.get("SSO_URL_INTERNAL", os.environ["SSO_URL"]),
+            enable_xray,
+            os.environ.get("SENTRY_DSN", None),
+            enable_sentry_tracing,
+            float(os.environ.get("SENTRY_TRACES_SAMPLE_RATE", "0.0")),
+            stream_chunk_size=int(os.environ.get("STREAM_CHUNK_SIZE", "16384")),
+            stream_max_chunk_size=int(
+                os.environ.get("STREAM_MAX_CHUNK_SIZE", "1048576")
+            ),
+            max_concurrent_connections=_int_or_none(
+                os.environ.get("MAX_CONCURRENT_CONNECTIONS")
+            ),
+            s3_max_pool_connections=_int_or_none(
+                os.environ.get("S3_MAX_POOL_CONNECTIONS")
+            ),
+            s3_connect_timeout=_float_or_none(os.environ.get("S3_CONNECT_TIMEOUT")),
+            s3_read_timeout=_float_or_none(os.environ.get("S3_READ_TIMEOUT")),
+            s3_tcp_keepalive=_bool(os.environ.get("S3_TCP_KEEPALIVE", "true")),
+            reuse_port=reuse_port,
+            session_cache_size=int(os.environ.get("SESSION_CACHE_SIZE", "0")),
+            session_cache_ttl=float(os.environ.get("SESSION_CACHE_TTL", "5")),
+            sso_max_pool_connections=int(
+                os.environ.get("SSO_MAX_POOL_CONNECTIONS", "10")
+            ),
+            sso_connect_timeout=float(os.environ.get("SSO_CONNECT_TIMEOUT", "5")),
+            sso_read_timeout=float(os.environ.get("SSO_READ_TIMEOUT", "10")),
+            sso_token_check_lock_timeout=float(
+                os.environ.get("SSO_TOKEN_CHECK_LOCK_TIMEOUT", "0")
+            ),
+            disk_cache_dir=os.environ.get("DISK_CACHE_DIR"),
+            disk_cache_max_size=int(
+                os.environ.get("DISK_CACHE_MAX_SIZE", "1073741824")
+            ),
+            disk_cache_max_object_size=int(
+                os.environ.get("DISK_CACHE_MAX_OBJECT_SIZE", "104857600")
+            ),
+            disk_cache_max_age=float(os.environ.get("DISK_CACHE_MAX_AGE", "0")),
+            memory_cache_max_size=int(os.environ.get("MEMORY_CACHE_MAX_SIZE", "0")),
+            memory_cache_max_object_size=int(
+                os.environ.get("MEMORY_CACHE_MAX_OBJECT_SIZE", "262144")
+            ),
+            memory_cache_max_age=float(os.environ.get("MEMORY_CACHE_MAX_AGE", "0")),
+            cache_control=os.environ.get("CACHE_CONTROL"),
+            parallel_download_min_size=int(
+                os.environ.get("PARALLEL_DOWNLOAD_MIN_SIZE", "0")
+            ),
+            parallel_download_part_size=int(
+                os.environ.get("PARALLEL_DOWNLOAD_PART_SIZE", "8388608")
+            ),
+            parallel_download_concurrency=int(
+                os.environ.get("PARALLEL_DOWNLOAD_CONCURRENCY", "4")
+            ),
+            read_ahead_block_size=int(os.environ.get("READ_AHEAD_BLOCK_SIZE", "0")),
+            read_ahead_cache_max_size=int(
+                os.environ.get("READ_AHEAD_CACHE_MAX_SIZE", "67108864")
+            ),
+            read_ahead_cache_ttl=float(os.environ.get("READ_AHEAD_CACHE_TTL", "10")),
+            stream_buffer_size=int(os.environ.get("STREAM_BUFFER_SIZE", "0")),
+            stream_min_throughput=float(os.environ.get("STREAM_MIN_THROUGHPUT", "0")),
+            stream_min_throughput_period=float(
+                os.environ.get("STREAM_MIN_THROUGHPUT_PERIOD", "10")
+            ),
+            compression_content_types=tuple(
+                content_type.strip().lower()
+                for content_type in os.environ.get(
+                    "COMPRESSION_CONTENT_TYPES", ""
+                ).split(",")
+                if content_type.strip()
+            ),
+            compression_min_size=int(os.environ.get("COMPRESSION_MIN_SIZE", "1024")),
+            precompressed_encodings=tuple(
+                encoding.strip().lower()
+                for encoding in os.environ.get("PRECOMPRESSED_ENCODINGS", "").split(",")
+                if encoding.strip()
+            ),
+            precompressed_cache_size=int(
+                os.environ.get("PRECOMPRESSED_CACHE_SIZE", "10000")
+            ),
+            precompressed_cache_ttl=float(
+                os.environ.get("PRECOMPRESSED_CACHE_TTL", "60")
+            ),
+            redirect_min_size=int(os.environ.get("REDIRECT_MIN_SIZE", "0")),
+            redirect_content_types=tuple(
+                content_type.strip().lower()
+                for content_type in os.environ.get("REDIRECT_CONTENT_TYPES", "").split(
+                    ","
+                )
+                if content_type.strip()
+            ),
+            presigned_url_expiry=int(os.environ.get("PRESIGNED_URL_EXPIRY", "300")),
+            presigned_url_cache_size=int(
+                os.environ.get("PRESIGNED_URL_CACHE_SIZE", "10000")
+            ),
+            zip_path=os.environ.get("ZIP_PATH"),
+            zip_max_keys=int(os.environ.get("ZIP_MAX_KEYS", "1000")),
+            zip_concurrency=int(os.environ.get("ZIP_CONCURRENCY", "4")),
+            enable_listing=_bool(os.environ.get("ENABLE_LISTING")),
+            listing_page_size=int(os.environ.get("LISTING_PAGE_SIZE", "1000")),
+            listing_cache_size=int(os.environ.get("LISTING_CACHE_SIZE", "1000")),
+            listing_cache_ttl=float(os.environ.get("LISTING_CACHE_TTL", "5")),
+            metrics_path=os.environ.get("METRICS_PATH"),
+            access_log_sample_rate=float(
+                os.environ.get("ACCESS_LOG_SAMPLE_RATE", "1.0")
+            ),
+            profiling_path=os.environ.get("PROFILING_PATH"),
+            profiling_token=os.environ.get("PROFILING_TOKEN"),
+            enable_server_timing=_bool(os.environ.get("ENABLE_SERVER_TIMING")),
+        )
 
-    gevent.signal.signal(signal.SIGTERM, stop)
-    start()
-    gevent.get_hub().join()
+        gevent.signal.signal(signal.SIGTERM, stop)
+        start()
+
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers == 1:
+        serve(reuse_port=False)
+    else:
+        run_workers(logger, workers, lambda: serve(reuse_port=True))
 
 
 if __name__ == "__main__":
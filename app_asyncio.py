@@ -0,0 +1,597 @@
+"""An alternative engine for the proxy, using asyncio rather than gevent
+
+Chosen by setting ENGINE=asyncio. It uses aiohttp both to serve clients and
+to make requests to S3 and SSO, with requests to S3 signed by botocore.
+Sessions are stored in Redis with the same keys as by the gevent engine, so
+both can serve the same users at once.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+import urllib.parse
+from email.utils import formatdate
+
+import redis.asyncio as redis
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from botocore.exceptions import NoCredentialsError
+from botocore.session import get_session
+from botocore.utils import check_dns_name
+from werkzeug.http import parse_date, parse_if_range_header, unquote_etag
+
+# suppress very verbose botocore logging
+logging.getLogger("botocore").setLevel(logging.CRITICAL)
+
+
+def proxy_app(
+    logger,
+    port,
+    redis_url,
+    sso_url,
+    sso_client_id,
+    sso_client_secret,
+    sso_token_check_grace_period,
+    bucket,
+    aws_region,
+    healthcheck_key,
+    key_prefix=None,
+    aws_access_key_id=None,
+    aws_secret_access_key=None,
+    s3_use_local=None,
+    s3_endpoint_url=None,
+    sso_url_internal=None,
+    stream_max_chunk_size=1048576,
+    s3_max_pool_connections=None,
+    s3_connect_timeout=None,
+    s3_read_timeout=None,
+    sso_max_pool_connections=10,
+    sso_connect_timeout=5,
+    sso_read_timeout=10,
+    sso_token_check_lock_timeout=0,
+    cache_control=None,
+    aws_session_token=None,
+):
+    proxied_request_headers = [
+        "range",
+    ]
+    conditional_request_headers = [
+        "if-match",
+        "if-none-match",
+        "if-modified-since",
+        "if-unmodified-since",
+    ]
+    proxied_response_headers = [
+        "accept-ranges",
+        "content-length",
+        "content-type",
+        "date",
+        "etag",
+        "last-modified",
+        "content-range",
+    ]
+    cache_control_headers = (
+        [("cache-control", cache_control)] if cache_control is not None else []
+    )
+    redis_prefix = "s3proxy"
+    redis_client = redis.from_url(redis_url)
+
+    if key_prefix is not None:
+        key_prefix += "/"
+    else:
+        key_prefix = ""
+
+    # As botocore addresses buckets by default: virtual-hosted style, unless
+    # the name isn't valid in a hostname, or has dots, which would fail
+    # validation of the certificate for *.s3.<region>.amazonaws.com
+    if s3_use_local is True:
+        s3_url = f"{s3_endpoint_url}/{bucket}/"
+    elif check_dns_name(bucket):
+        s3_url = f"https://{bucket}.s3.{aws_region}.amazonaws.com/"
+    else:
+        s3_url = f"https://s3.{aws_region}.amazonaws.com/{bucket}/"
+
+    # Resolved as botocore would for a client, but requests are signed and
+    # made directly, without botocore's per-request event handling. Without
+    # credentials no request could be signed, so that's found out on start
+    if aws_access_key_id is not None and aws_secret_access_key is not None:
+        s3_credentials = Credentials(
+            aws_access_key_id, aws_secret_access_key, aws_session_token
+        )
+    else:
+        s3_credentials = get_session().get_credentials()
+    if s3_credentials is None:
+        raise NoCredentialsError()
+
+    # The sessions, and their connection pools, must be created in the
+    # event loop, so are created on start
+    s3_session = None
+    sso_session = None
+
+    stopping = asyncio.Event()
+
+    async def start():
+        nonlocal s3_session, sso_session
+        s3_session = ClientSession(
+            connector=TCPConnector(limit=s3_max_pool_connections or 10),
+            timeout=ClientTimeout(
+                total=None, connect=s3_connect_timeout, sock_read=s3_read_timeout
+            ),
+            auto_decompress=False,
+        )
+        sso_session = ClientSession(
+            connector=TCPConnector(limit=sso_max_pool_connections),
+            timeout=ClientTimeout(
+                total=None, connect=sso_connect_timeout, sock_read=sso_read_timeout
+            ),
+        )
+
+        # As with the gevent engine, in-progress requests are completed
+        # however long they take, but no new connections are accepted
+        runner = web.AppRunner(app, shutdown_timeout=None)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        await stopping.wait()
+        await runner.cleanup()
+
+        await s3_session.close()
+        await sso_session.close()
+        await redis_client.close()
+
+    def stop():
+        stopping.set()
+
+    def authenticate_by_sso(f):
+        auth_path = "o/authorize/"
+        token_path = "o/token/"
+        me_path = "api/v1/user/me/"
+        grant_type = "authorization_code"
+        scope = "read write"
+        response_type = "code"
+
+        redirect_from_sso_path = "/__redirect_from_sso"
+
+        session_cookie_name = "assets_session_id"
+        session_state_key_prefix = "sso_state"
+        session_token_key = "sso_token"
+        session_token_checked_key = "sso_token_checked"
+        token_check_lock_prefix = "sso_token_check_lock"
+        token_check_result_prefix = "sso_token_check_result"
+
+        expired_message = (
+            b'<p style="font-weight: bold; font-family: Helvetica, Arial,'
+            b' sans-serif">Sign in may have taken too long. Please try the'
+            b" original link again.</p>"
+        )
+
+        cookie_max_age = 60 * 60 * 9
+        redis_max_age_session = 60 * 60 * 10
+        redis_max_age_state = 60
+
+        # Checks of tokens against SSO currently in progress in this process,
+        # keyed by the hash of the token, so concurrent requests for the same
+        # session share a single check
+        token_checks_in_progress = {}
+
+        async def _authenticate_by_sso(request):
+            if request.path == f"/{healthcheck_key}":
+                logger.debug("Allowing healthcheck")
+                return await f(request)
+
+            logger.debug("Authenticating %s", request)
+
+            async def get_session_values(*keys):
+                session_id = request.cookies[session_cookie_name]
+                return await redis_get_many_with_ttl(
+                    [f"{session_cookie_name}__{session_id}__{key}" for key in keys]
+                )
+
+            async def with_new_session_cookie(response, session_values):
+                is_secure = request.headers.get("x-forwarded-proto", "http") == "https"
+                session_id = secrets.token_urlsafe(64)
+                response.set_cookie(
+                    session_cookie_name,
+                    session_id,
+                    httponly=True,
+                    secure=is_secure,
+                    max_age=cookie_max_age,
+                    expires=formatdate(time.time() + cookie_max_age, usegmt=True),
+                )
+                session_key_prefix = f"{session_cookie_name}__{session_id}"
+                await redis_set_many(
+                    [
+                        (f"{session_key_prefix}__{key}", value, redis_max_age_session)
+                        for key, value in session_values.items()
+                    ]
+                    + [
+                        (
+                            f"{session_key_prefix}__{session_token_checked_key}",
+                            "checked",
+                            sso_token_check_grace_period,
+                        )
+                    ]
+                )
+
+                return response
+
+            def get_callback_uri():
+                scheme = request.headers.get("x-forwarded-proto", "http")
+                return f"{scheme}://{request.host}{redirect_from_sso_path}"
+
+            def get_request_url_with_scheme():
+                # The raw path preserves a trailing question mark
+                scheme = request.headers.get("x-forwarded-proto", "http")
+                return f"{scheme}://{request.host}{request.raw_path}"
+
+            async def redirect_to_sso():
+                logger.debug("Redirecting to SSO")
+                callback_uri = urllib.parse.quote(get_callback_uri(), safe="")
+                state = secrets.token_hex(32)
+                await redis_set(
+                    f"{session_state_key_prefix}__{state}",
+                    get_request_url_with_scheme(),
+                    redis_max_age_state,
+                )
+
+                redirect_to = (
+                    f"{sso_url}{auth_path}?"
+                    f"scope={scope}&state={state}&"
+                    f"redirect_uri={callback_uri}&"
+                    f"response_type={response_type}&"
+                    f"client_id={sso_client_id}"
+                )
+
+                return web.Response(status=302, headers={"location": redirect_to})
+
+            async def redirect_to_final():
+                try:
+                    code = request.query["code"]
+                    state = request.query["state"]
+                except KeyError:
+                    logger.exception("Missing code or state")
+                    return web.Response(status=400)
+
+                try:
+                    final_uri = await redis_get(f"{session_state_key_prefix}__{state}")
+                except KeyError:
+                    logger.exception("Unable to find state in Redis")
+                    return web.Response(
+                        body=expired_message,
+                        status=403,
+                        headers={"content-type": "text/html"},
+                    )
+
+                logger.debug("Attempting to redirect to final: %s", final_uri)
+
+                data = {
+                    "grant_type": grant_type,
+                    "code": code,
+                    "client_id": sso_client_id,
+                    "client_secret": sso_client_secret,
+                    "redirect_uri": get_callback_uri(),
+                }
+                async with sso_session.post(
+                    f"{sso_url_internal}{token_path}", data=data
+                ) as response:
+                    content = await response.read()
+
+                if response.status in [401, 403]:
+                    logger.debug("token_path response is %s", response.status)
+                    return web.Response(status=response.status)
+
+                if response.status != 200:
+                    logger.debug("token_path error")
+                    return web.Response(status=500)
+
+                return await with_new_session_cookie(
+                    web.Response(status=302, headers={"location": final_uri}),
+                    {session_token_key: json.loads(content)["access_token"]},
+                )
+
+            async def get_token_code(token):
+                async with sso_session.get(
+                    f"{sso_url_internal}{me_path}",
+                    headers={"authorization": f"Bearer {token}"},
+                ) as response:
+                    return response.status
+
+            async def get_token_code_coalesced(token):
+                # The check is shielded, so a client disconnecting doesn't
+                # cancel it for any others waiting on it
+                token_hash = hashlib.sha256(token.encode()).hexdigest()
+                try:
+                    check = token_checks_in_progress[token_hash]
+                except KeyError:
+                    check = asyncio.ensure_future(
+                        get_token_code_across_processes(token, token_hash)
+                    )
+                    token_checks_in_progress[token_hash] = check
+                    check.add_done_callback(
+                        lambda _: token_checks_in_progress.pop(token_hash)
+                    )
+                return await asyncio.shield(check)
+
+            async def get_token_code_across_processes(token, token_hash):
+                if not sso_token_check_lock_timeout:
+                    return await get_token_code(token)
+
+                lock_key = f"{token_check_lock_prefix}__{token_hash}"
+                result_key = f"{token_check_result_prefix}__{token_hash}"
+                lock_timeout_ms = int(sso_token_check_lock_timeout * 1000)
+
+                if await redis_set_if_not_exists(lock_key, "locked", lock_timeout_ms):
+                    token_code = await get_token_code(token)
+                    await redis_set_if_not_exists(
+                        result_key, str(token_code), lock_timeout_ms
+                    )
+                    return token_code
+
+                give_up_at = time.monotonic() + sso_token_check_lock_timeout
+                while time.monotonic() < give_up_at:
+                    try:
+                        return int(await redis_get(result_key))
+                    except KeyError:
+                        await asyncio.sleep(0.05)
+
+                return await get_token_code(token)
+
+            if request.path == redirect_from_sso_path:
+                return await redirect_to_final()
+
+            try:
+                (token, _), (token_checked, _) = await get_session_values(
+                    session_token_key, session_token_checked_key
+                )
+            except KeyError:
+                return await redirect_to_sso()
+
+            if token is None:
+                return await redirect_to_sso()
+
+            if token_checked is None:
+                logger.debug("Verifying access token")
+
+                token_code = await get_token_code_coalesced(token)
+
+                if token_code in [401, 403]:
+                    logger.debug("token_code response is %s", token_code)
+                    return await redirect_to_sso()
+
+                if token_code != 200:
+                    return web.Response(status=500)
+
+                session_id = request.cookies[session_cookie_name]
+                await redis_set(
+                    f"{session_cookie_name}__{session_id}__{session_token_checked_key}",
+                    "checked",
+                    sso_token_check_grace_period,
+                )
+
+            return await f(request)
+
+        return _authenticate_by_sso
+
+    @authenticate_by_sso
+    async def proxy(request):
+        logger.debug("Attempt to proxy: %s", request)
+
+        async def request_object(method, s3_key, headers):
+            # Credentials from the environment or a role are refreshed by
+            # botocore with blocking requests, so that's done in a thread
+            if getattr(s3_credentials, "refresh_needed", lambda: False)():
+                credentials = await asyncio.get_running_loop().run_in_executor(
+                    None, s3_credentials.get_frozen_credentials
+                )
+            else:
+                credentials = s3_credentials.get_frozen_credentials()
+            url = s3_url + urllib.parse.quote(s3_key, safe="/~")
+            aws_request = AWSRequest(method=method, url=url, headers=headers)
+            S3SigV4Auth(credentials, "s3", aws_region).add_auth(aws_request)
+            return await s3_session.request(
+                method, url, headers=dict(aws_request.headers.items())
+            )
+
+        def is_range_allowed(headers):
+            # S3 doesn't support If-Range, so it's emulated: the range only
+            # applies if the object has the exact ETag or date given. The
+            # comparison is strong, so a weak ETag never matches
+            if_range = parse_if_range_header(request.headers.get("if-range"))
+            if if_range.etag is not None:
+                _, is_weak = unquote_etag(request.headers["if-range"])
+                return (
+                    not is_weak
+                    and if_range.etag == unquote_etag(headers.get("etag"))[0]
+                )
+            if if_range.date is not None:
+                return if_range.date == parse_date(headers.get("last-modified"))
+            return True
+
+        method = request.method
+        path = request.match_info["path"] or "/"
+        s3_key = key_prefix + path
+        request_headers = {}
+        for key in proxied_request_headers + conditional_request_headers:
+            value = request.headers.get(key)
+            # Invalid dates must be ignored, rather than rejected by S3
+            if value is None or (key.endswith("-since") and parse_date(value) is None):
+                continue
+            request_headers[key] = value
+
+        s3_response = await request_object(method, s3_key, request_headers)
+        try:
+            if s3_response.status == 206 and not is_range_allowed(s3_response.headers):
+                s3_response.close()
+                del request_headers["range"]
+                s3_response = await request_object(method, s3_key, request_headers)
+
+            logger.debug("Status code: %s", s3_response.status)
+
+            if s3_response.status == 304:
+                return web.Response(
+                    status=304,
+                    headers=[
+                        (key, s3_response.headers[key])
+                        for key in ("etag",)
+                        if key in s3_response.headers
+                    ]
+                    + cache_control_headers,
+                )
+
+            # As with the gevent engine, errors other than those about the
+            # object or the request are server errors, not exposed to users
+            if s3_response.status in (404, 412, 416):
+                return web.Response(status=s3_response.status)
+            if s3_response.status not in (200, 206):
+                return web.Response(status=500)
+
+            response = web.StreamResponse(
+                status=s3_response.status,
+                headers=[
+                    (key, s3_response.headers[key])
+                    for key in proxied_response_headers
+                    if key in s3_response.headers
+                ]
+                + cache_control_headers,
+            )
+            await response.prepare(request)
+            if method != "HEAD":
+                async for chunk in s3_response.content.iter_chunked(
+                    stream_max_chunk_size
+                ):
+                    await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            s3_response.release()
+
+    async def redis_get(key):
+        value_bytes = await redis_client.get(f"{redis_prefix}__{key}")
+        if value_bytes is None:
+            raise KeyError(key)
+        return value_bytes.decode()
+
+    async def redis_get_many_with_ttl(keys):
+        prefixed_keys = [f"{redis_prefix}__{key}" for key in keys]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.mget(prefixed_keys)
+            for key in prefixed_keys:
+                pipe.pttl(key)
+            values, *ttls = await pipe.execute()
+        return [
+            (None if value_bytes is None else value_bytes.decode(), ttl / 1000)
+            for value_bytes, ttl in zip(values, ttls)
+        ]
+
+    async def redis_set(key, value, ex):
+        await redis_client.set(f"{redis_prefix}__{key}", value.encode(), ex=ex)
+
+    async def redis_set_if_not_exists(key, value, px):
+        return bool(
+            await redis_client.set(
+                f"{redis_prefix}__{key}", value.encode(), px=px, nx=True
+            )
+        )
+
+    async def redis_set_many(items):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, value, ex in items:
+                pipe.set(f"{redis_prefix}__{key}", value.encode(), ex=ex)
+            await pipe.execute()
+
+    # As with the gevent engine, timeouts, such as of requests to SSO, are
+    # server errors, rather than aiohttp's default of gateway timeouts
+    @web.middleware
+    async def timeouts_as_server_errors(request, handler):
+        try:
+            return await handler(request)
+        except asyncio.TimeoutError:
+            logger.exception("Timeout handling %s", request)
+            raise web.HTTPInternalServerError()
+
+    app = web.Application(middlewares=[timeouts_as_server_errors])
+    app.router.add_get("/{path:.*}", proxy)
+
+    return start, stop
+
+
+def main():
+    log_level = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setLevel(log_level)
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    logger.addHandler(stdout_handler)
+
+    def _int_or_none(value):
+        return int(value) if value else None
+
+    def _float_or_none(value):
+        return float(value) if value else None
+
+    s3_use_local = os.environ.get("S3_USE_LOCAL", False)
+    if s3_use_local and s3_use_local not in [0, "0", "false", "False"]:
+        s3_use_local = True
+
+    # prioritise VCAP_SERVICES since it's unlikely to be set except in PaaS,
+    # where it will be required as the valid endpoint
+    if "VCAP_SERVICES" in os.environ:
+        redis_url = json.loads(os.environ["VCAP_SERVICES"])["redis"][0]["credentials"][
+            "uri"
+        ]
+    else:
+        redis_url = os.environ["REDIS_ENDPOINT"]
+
+    async def serve():
+        start, stop = proxy_app(
+            logger,
+            int(os.environ["PORT"]),
+            redis_url,
+            os.environ["SSO_URL"],
+            os.environ["SSO_CLIENT_ID"],
+            os.environ["SSO_CLIENT_SECRET"],
+            int(os.environ.get("SSO_TOKEN_CHECK_GRACE_PERIOD", "3600")),
+            os.environ["AWS_S3_BUCKET"],
+            os.environ["AWS_DEFAULT_REGION"],
+            os.environ["AWS_S3_HEALTHCHECK_KEY"],
+            os.environ.get("KEY_PREFIX", None),
+            os.environ.get("AWS_ACCESS_KEY_ID", None),
+            os.environ.get("AWS_SECRET_ACCESS_KEY", None),
+            s3_use_local,
+            os.environ.get("S3_ENDPOINT_URL", None),
+            os.environ.get("SSO_URL_INTERNAL", os.environ["SSO_URL"]),
+            stream_max_chunk_size=int(
+                os.environ.get("STREAM_MAX_CHUNK_SIZE", "1048576")
+            ),
+            s3_max_pool_connections=_int_or_none(
+                os.environ.get("S3_MAX_POOL_CONNECTIONS")
+            ),
+            s3_connect_timeout=_float_or_none(os.environ.get("S3_CONNECT_TIMEOUT")),
+            s3_read_timeout=_float_or_none(os.environ.get("S3_READ_TIMEOUT")),
+            sso_max_pool_connections=int(
+                os.environ.get("SSO_MAX_POOL_CONNECTIONS", "10")
+            ),
+            sso_connect_timeout=float(os.environ.get("SSO_CONNECT_TIMEOUT", "5")),
+            sso_read_timeout=float(os.environ.get("SSO_READ_TIMEOUT", "10")),
+            sso_token_check_lock_timeout=float(
+                os.environ.get("SSO_TOKEN_CHECK_LOCK_TIMEOUT", "0")
+            ),
+            cache_control=os.environ.get("CACHE_CONTROL"),
+            aws_session_token=os.environ.get("AWS_SESSION_TOKEN"),
+        )
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+        await start()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()